@@ -4,6 +4,7 @@
 """
 
 import json
+import orjson
 import os
 import numpy as np
 import faiss
@@ -14,10 +15,27 @@ import hashlib
 import asyncio
 import aiohttp
 
+# Опциональный Parquet-sidecar метаданных: с установленным pyarrow
+# загрузка обходится без парсинга JSON с embedding-массивами внутри
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
 
 class EmbeddingsManager:
     """Управляет созданием embeddings и векторной БД."""
-    
+
+    # Порог, с которого выгоден сжатый IVF-PQ индекс вместо точного Flat:
+    # IVF256 требует на порядки больше векторов для обучения кластеров,
+    # а на малом корпусе полный перебор и так быстрее и точнее
+    _IVFPQ_MIN_VECTORS = 10_000
+    # Сколько кластеров IVF сканировать при поиске
+    _IVF_NPROBE = 8
+
+
     def __init__(self, api_key: str = None):
         """
         Инициализация менеджера embeddings.
@@ -32,10 +50,20 @@ class EmbeddingsManager:
         # Используем REST API напрямую (официальная модель: gemini-embedding-001)
         self.embed_model = "models/gemini-embedding-001"
         self.api_url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-embedding-001:embedContent"
+        self.batch_api_url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-embedding-001:batchEmbedContents"
         self.dimension = 768  # outputDimensionality для совместимости с индексом
+        # Сколько текстов отправлять одним batchEmbedContents вызовом
+        self.embed_batch_size = 16
         
+        # Общая HTTP-сессия: keep-alive соединение к API переживает
+        # серию embedContent-вызовов без повторных TLS-handshake'ов
+        self._http = requests.Session()
+
         self.index = None
         self.vectors_metadata = []
+        # Непрерывная float32 матрица (N, d) всех векторов корпуса —
+        # SoA-представление для векторизованного rerank-скоринга
+        self.vectors = None
         # Кэш для embeddings запросов
         self._query_embedding_cache = {}
         
@@ -83,82 +111,149 @@ class EmbeddingsManager:
             
         return "\n".join(text_parts)
     
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """
+        Создаёт embeddings для набора текстов одним вызовом batchEmbedContents:
+        HTTP/TLS и очередь на стороне API амортизируются на весь батч.
+
+        Args:
+            texts: Список текстов
+
+        Returns:
+            Список embeddings (в порядке текстов)
+        """
+        headers = {
+            'Content-Type': 'application/json',
+            'X-goog-api-key': self.api_key
+        }
+        payload = {
+            "requests": [
+                {
+                    "model": self.embed_model,
+                    "content": {"parts": [{"text": text}]},
+                    "outputDimensionality": self.dimension,
+                }
+                for text in texts
+            ]
+        }
+        response = self._http.post(self.batch_api_url, headers=headers, json=payload)
+        if response.status_code != 200:
+            raise Exception(f"Embedding API error {response.status_code}: {response.text}")
+        result = response.json()
+        return [e["values"] for e in result["embeddings"]]
+
+    def _embed_single(self, text: str) -> List[float]:
+        """
+        Создаёт embedding для одного текста вызовом embedContent.
+        Запасной путь для текстов, уронивших батчевый вызов.
+        """
+        headers = {
+            'Content-Type': 'application/json',
+            'X-goog-api-key': self.api_key
+        }
+        payload = {
+            "model": self.embed_model,
+            "content": {"parts": [{"text": text}]},
+            "outputDimensionality": self.dimension,
+        }
+        response = self._http.post(self.api_url, headers=headers, json=payload)
+        if response.status_code != 200:
+            raise Exception(f"Embedding API error {response.status_code}: {response.text}")
+        return response.json()["embedding"]["values"]
+
     def create_embeddings(self, songs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """
-        Создаёт embeddings для всех песен.
-        
+        Создаёт embeddings для всех песен батчами
+        (embed_batch_size текстов на один API вызов).
+
         Args:
             songs: Список словарей с данными песен
-            
+
         Returns:
             Список словарей с id, embedding и metadata
         """
         vectors = []
-        
+
         print(f"Создание embeddings для {len(songs)} песен...")
-        
-        for idx, song in enumerate(songs):
-            # Подготовка текста
-            text = self._prepare_song_text(song)
-            
-            # Создание embedding через REST API
+
+        for start in range(0, len(songs), self.embed_batch_size):
+            batch = songs[start:start + self.embed_batch_size]
+            texts = [self._prepare_song_text(song) for song in batch]
+
             try:
-                headers = {
-                    'Content-Type': 'application/json',
-                    'X-goog-api-key': self.api_key
-                }
-                payload = {
-                    "model": self.embed_model,
-                    "content": {"parts": [{"text": text}]},
-                    "outputDimensionality": self.dimension,
-                }
-                response = requests.post(self.api_url, headers=headers, json=payload)
-                if response.status_code != 200:
-                    error_detail = response.text
-                    raise Exception(f"{response.status_code} {error_detail}")
-                result = response.json()
-                embedding = result["embedding"]["values"]
-                
+                embeddings = self._embed_batch(texts)
+                embedded = list(zip(range(len(batch)), batch, embeddings))
+            except Exception as e:
+                # Падение батча (один слишком длинный текст, транзиентная
+                # ошибка) не должно выкидывать все его песни — пробуем
+                # каждую отдельно и пропускаем только реально сломанные
+                print(f"Ошибка батча, переходим на вызовы по одной песне: {e}")
+                embedded = []
+                for offset, (song, text) in enumerate(zip(batch, texts)):
+                    try:
+                        embedded.append((offset, song, self._embed_single(text)))
+                    except Exception as song_error:
+                        title = song.get('title', 'Unknown')
+                        print(f"Ошибка при обработке песни {title}: {song_error}")
+
+            for offset, song, embedding in embedded:
                 vectors.append({
-                    "id": song.get("id", idx),
+                    "id": song.get("id", start + offset),
                     "embedding": embedding,
                     "metadata": song
                 })
-                
-                if (idx + 1) % 10 == 0:
-                    print(f"Обработано {idx + 1}/{len(songs)} песен...")
-                    
-            except Exception as e:
-                print(f"Ошибка при обработке песни {song.get('title', 'Unknown')}: {e}")
-                continue
-        
+
+            print(f"Обработано {min(start + len(batch), len(songs))}/{len(songs)} песен...")
+
         print(f"Успешно создано {len(vectors)} embeddings!")
         return vectors
     
-    def build_index(self, vectors: List[Dict[str, Any]]) -> faiss.Index:
+    def build_index(self, vectors: List[Dict[str, Any]], quantize_int8: bool = False) -> faiss.Index:
         """
         Создаёт FAISS индекс из векторов.
-        
+
         Args:
             vectors: Список словарей с embeddings
-            
+            quantize_int8: Хранить вектора скалярно квантованными в int8:
+                           4x меньше памяти и трафика из неё при небольшой
+                           потере точности. Запрос квантуется FAISS'ом
+                           автоматически при поиске.
+
         Returns:
             FAISS индекс
         """
         if not vectors:
             raise ValueError("Список векторов пуст!")
-        
-        # Создание индекса
-        self.index = faiss.IndexFlatL2(self.dimension)
-        
-        # Подготовка массива embeddings
+
+        # Подготовка массива embeddings. Вектора нормируются один раз при
+        # сборке, и индекс работает по скалярному произведению: косинус
+        # считается одним dot вместо |a|²+|b|²−2a·b у L2-метрики
         embeddings_array = np.array([v["embedding"] for v in vectors]).astype("float32")
-        
+        faiss.normalize_L2(embeddings_array)
+
+        # Создание индекса: на большом корпусе — сжатый IVF-PQ
+        # (~16x меньше памяти на вектор, сканируется nprobe/nlist корпуса),
+        # иначе int8-квантованный или точный Flat
+        if len(vectors) >= self._IVFPQ_MIN_VECTORS:
+            self.index = faiss.index_factory(
+                self.dimension, "IVF256,PQ32x8", faiss.METRIC_INNER_PRODUCT
+            )
+            self.index.train(embeddings_array)
+            self.index.nprobe = self._IVF_NPROBE
+        elif quantize_int8:
+            self.index = faiss.IndexScalarQuantizer(
+                self.dimension, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+            )
+            self.index.train(embeddings_array)
+        else:
+            self.index = faiss.IndexFlatIP(self.dimension)
+
         # Добавление в индекс
         self.index.add(embeddings_array)
-        
-        # Сохранение метаданных
+
+        # Сохранение метаданных и контигуозной матрицы векторов
         self.vectors_metadata = vectors
+        self.vectors = np.ascontiguousarray(embeddings_array)
         
         print(f"Индекс создан! Размер: {self.index.ntotal} векторов")
         return self.index
@@ -186,7 +281,45 @@ class EmbeddingsManager:
         
         print(f"Индекс сохранён: {index_path}")
         print(f"Метаданные сохранены: {metadata_path} (модель: {self.embed_model})")
-    
+
+        # Обновляем sidecar с матрицей векторов: при пересборке корпуса
+        # с тем же числом песен старый файл прошёл бы проверку размера,
+        # и rerank работал бы по устаревшим векторам
+        if self.vectors is not None:
+            matrix_path = self._matrix_sidecar_path(metadata_path)
+            tmp_path = matrix_path + ".tmp"
+            np.ascontiguousarray(self.vectors, dtype=np.float32).tofile(tmp_path)
+            os.replace(tmp_path, matrix_path)
+
+        self._save_metadata_parquet(metadata_path)
+
+    def _parquet_sidecar_path(self, metadata_path: str) -> str:
+        """Путь к Parquet-sidecar'у рядом с JSON-метаданными."""
+        return os.path.splitext(metadata_path)[0] + ".parquet"
+
+    def _matrix_sidecar_path(self, metadata_path: str) -> str:
+        """Путь к sidecar-файлу с float32 матрицей векторов."""
+        return os.path.splitext(metadata_path)[0] + "_vectors.f32"
+
+    def _save_metadata_parquet(self, metadata_path: str):
+        """
+        Пишет колоночный sidecar метаданных (без embedding'ов — они лежат
+        в *_vectors.f32). JSON-файл остаётся источником истины, sidecar —
+        быстрый путь загрузки при наличии pyarrow.
+        """
+        if pa is None:
+            return
+        try:
+            table = pa.table({
+                "id": [str(v.get("id", i)) for i, v in enumerate(self.vectors_metadata)],
+                "metadata": [orjson.dumps(v["metadata"]) for v in self.vectors_metadata],
+            })
+            table = table.replace_schema_metadata({"embed_model": self.embed_model})
+            pq.write_table(table, self._parquet_sidecar_path(metadata_path))
+        except Exception as e:
+            # Sidecar — только оптимизация, его отсутствие не ломает загрузку
+            print(f"⚠️  Не удалось записать Parquet-sidecar: {e}")
+
     def load_index(self, index_path: str, metadata_path: str):
         """
         Загружает индекс и метаданные с диска.
@@ -194,27 +327,107 @@ class EmbeddingsManager:
         для корректного поиска нужно пересобрать индекс (prepare_embeddings.py).
         """
         self.index = faiss.read_index(index_path)
-        
-        with open(metadata_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        # Поддержка старого формата (только список) и нового (с _index_info)
-        if isinstance(data, list):
-            self.vectors_metadata = data
-        else:
-            self.vectors_metadata = data.get("vectors", data)
-            info = data.get("_index_info", {})
-            saved_model = info.get("embed_model")
-            if saved_model and saved_model != self.embed_model:
-                print(
-                    f"⚠️  Внимание: индекс собран моделью '{saved_model}', "
-                    f"а запросы делаются моделью '{self.embed_model}'. "
-                    "Для корректного семантического поиска пересоберите индекс: "
-                    "запустите prepare_embeddings.py"
+        # Для IVF-индексов задаём число сканируемых кластеров
+        if hasattr(self.index, "nprobe"):
+            self.index.nprobe = self._IVF_NPROBE
+
+        saved_model = None
+        parquet_path = self._parquet_sidecar_path(metadata_path)
+        if pq is not None and os.path.exists(parquet_path):
+            # Быстрый путь: Parquet-sidecar без embedding'ов — вектора
+            # подключатся из *_vectors.f32 ниже
+            table = pq.read_table(parquet_path)
+            self.vectors_metadata = [
+                {"id": song_id, "metadata": orjson.loads(meta)}
+                for song_id, meta in zip(
+                    table.column("id").to_pylist(), table.column("metadata").to_pylist()
                 )
-        
+            ]
+            schema_meta = table.schema.metadata or {}
+            saved_model = schema_meta.get(b"embed_model", b"").decode() or None
+        else:
+            # orjson: C-парсер строит дерево метаданных в разы быстрее stdlib json
+            with open(metadata_path, 'rb') as f:
+                data = orjson.loads(f.read())
+
+            # Поддержка старого формата (только список) и нового (с _index_info)
+            if isinstance(data, list):
+                self.vectors_metadata = data
+            else:
+                self.vectors_metadata = data.get("vectors", data)
+                saved_model = data.get("_index_info", {}).get("embed_model")
+
+        if saved_model and saved_model != self.embed_model:
+            print(
+                f"⚠️  Внимание: индекс собран моделью '{saved_model}', "
+                f"а запросы делаются моделью '{self.embed_model}'. "
+                "Для корректного семантического поиска пересоберите индекс: "
+                "запустите prepare_embeddings.py"
+            )
+
+
+        self._load_vector_matrix(metadata_path)
+
         print(f"Индекс загружен: {self.index.ntotal} векторов")
-    
+
+    def _load_vector_matrix(self, metadata_path: str):
+        """
+        Готовит непрерывную float32 матрицу (N, d) всех векторов корпуса.
+        В отличие от списка словарей (AoS), выборка строк по индексам и
+        матричный продукт по ней не обходят Python-объекты. Матрица лежит
+        в sidecar-файле рядом с метаданными и подключается через np.memmap,
+        так что резидентной остаётся только горячая часть страниц.
+        """
+        n = len(self.vectors_metadata)
+        if n == 0:
+            self.vectors = None
+            return
+
+        matrix_path = self._matrix_sidecar_path(metadata_path)
+        expected_size = n * self.dimension * 4  # float32
+
+        # Sidecar устарел, если его нет, размер не совпадает или метаданные
+        # перезаписаны позже него (пересборка корпуса с тем же числом песен)
+        stale = (
+            not os.path.exists(matrix_path)
+            or os.path.getsize(matrix_path) != expected_size
+            or os.path.getmtime(matrix_path) < os.path.getmtime(metadata_path)
+        )
+        if stale:
+            # Пересобираем sidecar из метаданных (или из индекса,
+            # если embedding в записи отсутствует — например, метаданные
+            # пришли из Parquet-sidecar'а без векторов)
+            need_reconstruct = any(
+                v.get("embedding") is None for v in self.vectors_metadata
+            )
+            if need_reconstruct and self.index is not None and hasattr(self.index, "make_direct_map"):
+                # IVF-индексы не умеют reconstruct без прямой карты id -> код
+                self.index.make_direct_map()
+            matrix = np.zeros((n, self.dimension), dtype=np.float32)
+            for i, vector in enumerate(self.vectors_metadata):
+                embedding = vector.get("embedding")
+                if embedding is not None:
+                    matrix[i] = np.asarray(embedding, dtype=np.float32)
+                elif self.index is not None:
+                    matrix[i] = self.index.reconstruct(i)
+            tmp_path = matrix_path + ".tmp"
+            matrix.tofile(tmp_path)
+            os.replace(tmp_path, matrix_path)
+
+        self.vectors = np.memmap(
+            matrix_path, dtype=np.float32, mode="r", shape=(n, self.dimension)
+        )
+
+    def _normalize_for_index(self, embedding_array: np.ndarray) -> np.ndarray:
+        """
+        Нормирует вектор запроса только для inner-product индекса.
+        Старый L2-индекс на диске хранит ненормированные вектора —
+        нормировка запроса исказила бы его дистанции и проценты.
+        """
+        if self.index is not None and self.index.metric_type == faiss.METRIC_INNER_PRODUCT:
+            faiss.normalize_L2(embedding_array)
+        return embedding_array
+
     def get_query_embedding(self, query: str) -> np.ndarray:
         """
         Создаёт embedding для запроса пользователя с кэшированием.
@@ -242,14 +455,15 @@ class EmbeddingsManager:
             "content": {"parts": [{"text": query}]},
             "outputDimensionality": self.dimension,
         }
-        response = requests.post(self.api_url, headers=headers, json=payload)
+        response = self._http.post(self.api_url, headers=headers, json=payload)
         if response.status_code != 200:
             error_detail = response.text
             raise Exception(f"Embedding API error {response.status_code}: {error_detail}")
         result = response.json()
         embedding = result["embedding"]["values"]
         embedding_array = np.array([embedding]).astype("float32")
-        
+        self._normalize_for_index(embedding_array)
+
         # Сохраняем в кэш (ограничиваем размер кэша до 1000 записей)
         if len(self._query_embedding_cache) >= 1000:
             # Удаляем самую старую запись (FIFO)
@@ -259,6 +473,44 @@ class EmbeddingsManager:
         self._query_embedding_cache[cache_key] = embedding_array
         return embedding_array
     
+    def get_query_embeddings_batch(self, queries: List[str]) -> List[np.ndarray]:
+        """
+        Создаёт embeddings для нескольких запросов, забирая промахи кэша
+        одним batchEmbedContents вызовом вместо запроса на каждый текст.
+
+        Args:
+            queries: Список текстов запросов
+
+        Returns:
+            Список NumPy массивов с embeddings (в порядке запросов)
+        """
+        results: List[Any] = [None] * len(queries)
+        miss_indices = []
+        miss_queries = []
+
+        for i, query in enumerate(queries):
+            cache_key = hashlib.md5(query.encode('utf-8')).hexdigest()
+            cached = self._query_embedding_cache.get(cache_key)
+            if cached is not None:
+                results[i] = cached
+            else:
+                miss_indices.append(i)
+                miss_queries.append(query)
+
+        if miss_queries:
+            embeddings = self._embed_batch(miss_queries)
+            for i, embedding in zip(miss_indices, embeddings):
+                embedding_array = np.array([embedding]).astype("float32")
+                self._normalize_for_index(embedding_array)
+                if len(self._query_embedding_cache) >= 1000:
+                    oldest_key = next(iter(self._query_embedding_cache))
+                    del self._query_embedding_cache[oldest_key]
+                cache_key = hashlib.md5(queries[i].encode('utf-8')).hexdigest()
+                self._query_embedding_cache[cache_key] = embedding_array
+                results[i] = embedding_array
+
+        return results
+
     async def get_query_embedding_async(self, query: str, session: aiohttp.ClientSession) -> np.ndarray:
         """
         Асинхронная версия создания embedding для запроса.
@@ -292,7 +544,8 @@ class EmbeddingsManager:
             result = await response.json()
             embedding = result["embedding"]["values"]
             embedding_array = np.array([embedding]).astype("float32")
-            
+            self._normalize_for_index(embedding_array)
+
             # Сохраняем в кэш
             if len(self._query_embedding_cache) >= 1000:
                 oldest_key = next(iter(self._query_embedding_cache))
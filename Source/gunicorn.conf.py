@@ -0,0 +1,20 @@
+"""
+Конфигурация gunicorn для веб-приложения.
+Запросы почти целиком ждут внешние API (Gemini), поэтому вместо двух
+синхронных воркеров используется один gevent-воркер: сотни I/O-bound
+запросов обрабатываются конкурентно.
+
+preload_app выключен намеренно: с preload приложение импортируется в
+мастере ДО monkey.patch_all() воркера, и модульный ThreadPoolExecutor
+(и ssl/requests) получают непропатченные примитивы — простаивающий
+поток экзекьютора затем нативно блокируется в SimpleQueue.get() и
+замораживает весь event loop. gevent-воркер патчит до загрузки
+приложения, а copy-on-write экономия на одном воркере с маленьким
+индексом всё равно ничего не даёт.
+"""
+
+workers = 1
+worker_class = "gevent"
+worker_connections = 200
+preload_app = False
+timeout = 120
@@ -5,10 +5,18 @@
 
 import numpy as np
 import re
+import faiss
 from typing import List, Dict, Any
 from collections import Counter
 from embeddings_manager import EmbeddingsManager
 
+# SIMD-ядра косинусной близости (AVX2/AVX-512) — опциональное ускорение;
+# без simsimd используется матричный продукт NumPy (BLAS)
+try:
+    import simsimd
+except ImportError:
+    simsimd = None
+
 
 class SongSearch:
     """Класс для поиска песен по семантическому запросу."""
@@ -41,23 +49,68 @@ class SongSearch:
         """
         # Создание embedding для запроса
         query_embedding = self.embeddings_manager.get_query_embedding(query)
-        
+
         # Поиск в индексе
         distances, indices = self.embeddings_manager.index.search(query_embedding, k)
-        
-        # Получение метаданных найденных песен
+
+        return self._materialize_hits(indices[0], distances[0])
+
+    def search_batch(self, queries: List[str], k: int = 5) -> List[List[Dict[str, Any]]]:
+        """
+        Ищет кандидатов сразу для нескольких запросов одним обращением к FAISS:
+        embeddings берутся батчем, запросы складываются в одну матрицу, и
+        индекс сканируется один раз для всех строк (кэш индекса остаётся
+        горячим между запросами батча).
+
+        Args:
+            queries: Список текстов запросов
+            k: Количество песен на запрос
+
+        Returns:
+            Список списков результатов (в порядке запросов)
+        """
+        if not queries:
+            return []
+
+        embeddings = self.embeddings_manager.get_query_embeddings_batch(queries)
+        query_matrix = np.vstack(embeddings)
+        distances, indices = self.embeddings_manager.index.search(query_matrix, k)
+
+        return [
+            self._materialize_hits(indices[row], distances[row])
+            for row in range(len(queries))
+        ]
+
+    def _materialize_hits(self, indices_row, distances_row) -> List[Dict[str, Any]]:
+        """
+        Превращает одну строку результата FAISS в список словарей песен
+        с дистанцией, номером строки индекса и процентом соответствия.
+        """
         results = []
-        for idx, distance in zip(indices[0], distances[0]):
-            if idx < len(self.embeddings_manager.vectors_metadata):
-                song_data = self.embeddings_manager.vectors_metadata[idx]["metadata"].copy()
-                song_data["similarity_distance"] = float(distance)
-                results.append(song_data)
-        
-        # Реальный процент соответствия по L2: 0% при distance=2, 100% при distance=0 (норм. векторы)
+        for idx, distance in zip(indices_row, distances_row):
+            # FAISS добивает неполные результаты индексом -1 (реально для
+            # IVF с малым nprobe) — отрицательный idx выбрал бы последнюю песню
+            if 0 <= idx < len(self.embeddings_manager.vectors_metadata):
+                meta = self.embeddings_manager.vectors_metadata[idx]["metadata"]
+                # {**meta, ...} — одно C-слияние вместо copy() + поэлементных присваиваний;
+                # faiss_idx (номер строки в индексе) нужен для выборки вектора при rerank'е
+                results.append({
+                    **meta,
+                    "similarity_distance": float(distance),
+                    "faiss_idx": int(idx),
+                })
+
+        # Реальный процент соответствия по метрике индекса: для inner product
+        # на нормированных векторах distance — это косинус (100% при 1.0),
+        # для L2 — 0% при distance=2, 100% при distance=0 (норм. векторы)
+        metric = getattr(self.embeddings_manager.index, "metric_type", faiss.METRIC_L2)
         for r in results:
             d = r["similarity_distance"]
-            r["match_percent"] = max(0.0, min(100.0, 100.0 * (1.0 - min(d, 2.0) / 2.0)))
-        
+            if metric == faiss.METRIC_INNER_PRODUCT:
+                r["match_percent"] = max(0.0, min(100.0, 100.0 * d))
+            else:
+                r["match_percent"] = max(0.0, min(100.0, 100.0 * (1.0 - min(d, 2.0) / 2.0)))
+
         return results
     
     def search_with_filters(
@@ -171,13 +224,37 @@ class SongSearch:
             density = min(1.0, hits / max(len(query_set) * 2, 1))  # несколько упоминаний = лучше
             score = 0.7 * coverage + 0.3 * min(1.0, density)
             
-            song_data = self.embeddings_manager.vectors_metadata[idx]["metadata"].copy()
-            song_data["keyword_score"] = score
-            scores.append((score, song_data))
+            meta = self.embeddings_manager.vectors_metadata[idx]["metadata"]
+            scores.append((score, {**meta, "keyword_score": score}))
         
         scores.sort(reverse=True, key=lambda x: x[0])
         return [song for _, song in scores[:k]]
     
+    def _cosine_scores(self, query_vec: np.ndarray, matrix: np.ndarray) -> np.ndarray:
+        """
+        Косинусная близость запроса ко всем строкам матрицы одной операцией.
+        С установленным simsimd используются SIMD-ядра; без него —
+        нормированный матричный продукт NumPy (BLAS).
+
+        Args:
+            query_vec: Вектор запроса (1, d) или (d,)
+            matrix: Матрица векторов кандидатов (n, d), float32
+
+        Returns:
+            Массив косинусов (n,)
+        """
+        if simsimd is not None:
+            distances = np.asarray(
+                simsimd.cdist(query_vec.reshape(1, -1), matrix, metric="cosine")
+            )
+            return 1.0 - distances.ravel()
+
+        q = query_vec.ravel()
+        q_norm = np.linalg.norm(q) or 1.0
+        row_norms = np.linalg.norm(matrix, axis=1)
+        row_norms[row_norms == 0] = 1.0
+        return (matrix @ q) / (row_norms * q_norm)
+
     def hybrid_search(self, query: str, k: int = 5, semantic_weight: float = 0.7, keyword_weight: float = 0.3) -> List[Dict[str, Any]]:
         """
         Гибридный поиск: комбинация семантического и keyword поиска.
@@ -188,13 +265,36 @@ class SongSearch:
         semantic_results = self.search(query, k=max(k * 2, 30))
         # Keyword — все песни, где есть хотя бы одно слово из запроса (до 80)
         keyword_results = self._keyword_search(query, k=80)
-        
+
+        # Семантическую оценку считаем как настоящий косинус по хранимым
+        # векторам кандидатов — одним вызовом на весь срез, без питоновского
+        # цикла по парам (embedding запроса берётся из кэша)
+        semantic_scores = None
+        if semantic_results:
+            indices = np.array([song["faiss_idx"] for song in semantic_results], dtype=np.int64)
+            corpus_vectors = self.embeddings_manager.vectors
+            if corpus_vectors is not None:
+                # Выборка строк из общей контигуозной матрицы: один fancy-index
+                # вместо обхода списка словарей метаданных
+                candidate_vectors = np.ascontiguousarray(corpus_vectors[indices])
+            else:
+                candidate_vectors = np.array(
+                    [
+                        self.embeddings_manager.vectors_metadata[i]["embedding"]
+                        for i in indices
+                    ],
+                    dtype=np.float32
+                )
+            query_embedding = self.embeddings_manager.get_query_embedding(query)
+            semantic_scores = np.clip(
+                self._cosine_scores(query_embedding, candidate_vectors), 0.0, 1.0
+            )
+
         combined_scores = {}
-        
-        for song in semantic_results:
+
+        for pos, song in enumerate(semantic_results):
             song_id = song.get("id", id(song))
-            distance = song.get("similarity_distance", 1.0)
-            raw_sem = 1.0 / (1.0 + distance)
+            raw_sem = float(semantic_scores[pos])
             combined_scores[song_id] = {
                 "song": song,
                 "semantic_score": raw_sem,
@@ -234,9 +334,11 @@ class SongSearch:
             kw = data["keyword_score"]
             theme_bonus = 0.2 * kw if kw > 0 else 0.0
             final_score = (semantic_weight * sem + keyword_weight * kw) + theme_bonus
-            song = data["song"].copy()
-            song["hybrid_score"] = min(1.0, final_score)
-            song["similarity_distance"] = data["song"].get("similarity_distance", 1.0)
+            song = {
+                **data["song"],
+                "hybrid_score": min(1.0, final_score),
+                "similarity_distance": data["song"].get("similarity_distance", 1.0),
+            }
             final_results.append((final_score, song))
         
         final_results.sort(reverse=True, key=lambda x: x[0])
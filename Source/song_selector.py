@@ -3,27 +3,390 @@
 Использует reasoning LLM для анализа и выбора оптимальной песни.
 """
 
+import logging
 import os
+import re
 import requests
+import sqlite3
+import threading
 import time
 import json
+import random
 import asyncio
 import aiohttp
-from typing import List, Dict, Any
+import hashlib
+import msgspec
+import orjson
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, AsyncIterator, Tuple
+
+# Ошибки и переключения моделей логируются лениво (%-форматирование),
+# чтобы retry-штормы не упирались в синхронный stdout. По умолчанию тихо:
+# NullHandler, конфигурацию выбирает приложение.
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class _LLMCache:
+    """
+    LRU-кэш результатов выбора песни в памяти процесса.
+    Повторный запрос с тем же набором кандидатов отдаётся без обращения к API.
+    """
+
+    def __init__(self, maxsize: int = 512):
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key: str):
+        result = self._data.get(key)
+        if result is not None:
+            self._data.move_to_end(key)
+        return result
+
+    def set(self, key: str, value: Dict[str, Any]):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._data
+
+
+class SqliteBackend:
+    """
+    Персистентный ярус кэша решений на stdlib sqlite3 с TTL.
+    В отличие от in-proc LRU переживает рестарты процесса и разделяется
+    между gunicorn-воркерами (файл общий). Значения хранятся как orjson-блобы.
+    """
+
+    def __init__(self, path: str = None, ttl: float = 86400.0):
+        """
+        Args:
+            path: Путь к файлу БД (по умолчанию ~/.cache/song_selector/llm_cache.sqlite3)
+            ttl: Время жизни записи в секундах (по умолчанию сутки)
+        """
+        if path is None:
+            path = os.path.join(
+                os.path.expanduser("~"), ".cache", "song_selector", "llm_cache.sqlite3"
+            )
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires_at REAL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str):
+        """Возвращает закэшированное значение или None (просрочка = промах)."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at < time.time():
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+        try:
+            return orjson.loads(value)
+        except ValueError:
+            return None
+
+    def set(self, key: str, value: Dict[str, Any]):
+        """Сохраняет значение с TTL, попутно вычищая просроченные записи."""
+        try:
+            blob = orjson.dumps(value)
+        except TypeError:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, blob, now + self.ttl)
+            )
+            self._conn.execute("DELETE FROM cache WHERE expires_at < ?", (now,))
+            self._conn.commit()
+
+
+class _TokenBucket:
+    """
+    Асинхронный token bucket: упреждающий rate limiting для всех конкурентных
+    вызовов API. Квота Gemini задана в запросах-в-минуту, поэтому ведро не даёт
+    отправлять запросы, которые гарантированно получат 429, — вместо впустую
+    потраченного round-trip запрос просто ждёт пополнения токенов.
+    """
+
+    def __init__(self, capacity: float = 60.0, refill_per_sec: float = 1.0):
+        self.capacity = capacity
+        self.refill_per_sec = refill_per_sec
+        self.tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.refill_per_sec)
+        self._updated = now
+
+    async def acquire(self, n: float = 1.0):
+        """Ждёт, пока в ведре накопится n токенов, и забирает их."""
+        while True:
+            async with self._lock:
+                self._refill()
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                wait_time = (n - self.tokens) / self.refill_per_sec
+            await asyncio.sleep(wait_time)
+
+    def penalize(self):
+        """Осушает половину ведра после 429: реальная квота ниже, чем мы думали."""
+        self._refill()
+        self.tokens *= 0.5
+
+
+class _ChooseDecision(msgspec.Struct):
+    """Типизированное решение модели в Structured Output режиме."""
+    selected_index: int
+    reasoning: str = ""
+    confidence: float = 0.5
+
+
+# C-уровневые кодек/декодер msgspec: декодирование ответа сразу с валидацией
+# типов, кодирование payload быстрее stdlib json.dumps
+_DECISION_DECODER = msgspec.json.Decoder(_ChooseDecision)
+_JSON_ENCODER = msgspec.json.Encoder()
+
+
+class _ResponseView:
+    """
+    Лёгкая обёртка (status_code, text, headers) над ответом aiohttp, чтобы
+    переиспользовать классификацию ошибок, написанную для requests.Response.
+    """
+    __slots__ = ("status_code", "text", "headers")
+
+    def __init__(self, status_code: int, text: str, headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+# База REST API Gemini; полные URL моделей кэшируются в self._model_urls
+_API_BASE = "https://generativelanguage.googleapis.com/v1beta/models"
+
+# Сколько байт тела ошибки читать: промежуточные прокси могут отдавать большие
+# HTML-страницы, а для классификации и сообщения хватает начала тела
+_ERROR_BODY_CAP = 2048
+
+# Служебный текст в enhanced_query ("Here is the JSON..." и т.п.) — признак того,
+# что модель вернула не сам запрос, а обёртку вокруг него
+_ENHANCED_BAD_RE = re.compile(r'here is|\A.{0,46}json', re.IGNORECASE | re.DOTALL)
+
+# Шаблоны промптов. Статическая часть (инструкция + few-shot примеры) собирается
+# один раз при импорте модуля; на каждый вызов подставляются только запрос и кандидаты.
+# Один шаблон используется и в choose_best, и в choose_best_async.
+_FEWSHOT_HEADER = """Ты христианский эксперт, выбери лучшую христианскую песню из кандидатов для запроса пользователя.
+
+Пример:
+Запрос: "Хочу спокойную песню для вечера"
+1. Тихая ночь (спокойная, умиротворённая)
+2. Утренняя радость (энергичная, радостная)
+ВЫБОР: 1
+ОБЪЯСНЕНИЕ: "Тихая ночь" подходит для вечера - спокойная и умиротворённая."""
+
+# Инструкция и few-shot пример передаются через systemInstruction: эта часть
+# одинакова для всех запросов, и Gemini может переиспользовать её KV-кэш
+_CHOOSE_SYSTEM_INSTRUCTION = {"parts": [{"text": _FEWSHOT_HEADER}]}
+
+_CHOOSE_PROMPT = """Запрос: "{query}"
+Кандидаты:
+{candidates}
+
+Выбери ОДНУ песню, наиболее соответствующую запросу, и объясни почему."""
+
+_ENHANCE_PROMPT = """Улучши запрос пользователя для поиска христианских песен. Определи тему, настроение, ключевые слова и сформируй улучшенный запрос для векторного поиска.
+
+Важно: В enhanced_query обязательно добавь синонимы и тематически близкие слова (например: осень → листья, листопад, природа, смена пор года, урожай; зима → снег, холод; весна → пробуждение, цветы). Это нужно, чтобы поиск находил песни по смыслу и по формулировкам в текстах.
+
+Примеры:
+"мне грустно" → theme: грусть/утешение, mood: грустное, keywords: одиночество/поддержка, enhanced_query: "христианская песня про грусть, печаль, одиночество, утешение, поддержку"
+"Осень, падают листья" → theme: природа/времена года, mood: размышление, keywords: осень/листья/листопад/природа, enhanced_query: "осень, падающие листья, листопад, природа, смена пор года, творение, благодарность за природу"
+"хочу спокойное для вечера" → theme: покой/размышление, mood: спокойное, keywords: вечер/тишина, enhanced_query: "спокойная христианская песня для вечера, умиротворение, тишина, покой"
+
+Запрос: "{query}"
+
+Верни ТОЛЬКО JSON без текста/комментариев/markdown:
+{{
+  "theme": "тема",
+  "mood": "настроение",
+  "keywords": "ключевые слова",
+  "enhanced_query": "улучшенный запрос с синонимами и тематическими словами"
+}}"""
+
+# Схемы Structured Output и generationConfig не меняются между вызовами —
+# собираем их один раз при импорте, чтобы не аллоцировать вложенные словари
+# на каждый запрос. Используются в choose_best, choose_best_async и enhance_query.
+_CHOOSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "selected_index": {
+            "type": "integer",
+            "description": "Номер выбранной песни (1-based)"
+        },
+        "reasoning": {
+            "type": "string",
+            "description": "Подробное объяснение, почему эта песня лучше всего подходит запросу пользователя"
+        },
+        "confidence": {
+            "type": "number",
+            "description": "Уверенность в выборе от 0 до 1"
+        }
+    },
+    "required": ["selected_index", "reasoning"]
+}
+
+_CHOOSE_GEN_CONFIG = {
+    "temperature": 0.7,
+    "responseMimeType": "application/json",
+    "responseSchema": _CHOOSE_SCHEMA
+}
+
+# Неизменяемые части тела запроса выбора сериализуются один раз при импорте:
+# в горячем пути кодируется только сам промпт, без пересборки словаря payload
+_CHOOSE_BODY_PREFIX = (
+    b'{"systemInstruction":' + orjson.dumps(_CHOOSE_SYSTEM_INSTRUCTION) +
+    b',"contents":[{"parts":[{"text":'
+)
+_CHOOSE_BODY_SUFFIX = (
+    b'}]}],"generationConfig":' + orjson.dumps(_CHOOSE_GEN_CONFIG) + b'}'
+)
+
+_ENHANCE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "theme": {
+            "type": "string",
+            "description": "Основная тема запроса"
+        },
+        "mood": {
+            "type": "string",
+            "description": "Настроение запроса"
+        },
+        "keywords": {
+            "type": "string",
+            "description": "Ключевые слова через запятую"
+        },
+        "enhanced_query": {
+            "type": "string",
+            "description": "Улучшенный запрос для векторного поиска"
+        }
+    },
+    "required": ["theme", "mood", "keywords", "enhanced_query"]
+}
+
+_ENHANCE_GEN_CONFIG = {
+    "temperature": 0.3,  # Низкая температура для более детерминированного результата
+    "maxOutputTokens": 300,
+    "responseMimeType": "application/json",
+    "responseSchema": _ENHANCE_SCHEMA
+}
+
+# Сколько секунд не трогать модель после того, как она ответила перегрузкой
+_OVERLOAD_COOLDOWN_SEC = 30.0
+
+# Circuit breaker: модель со скользящим success rate ниже порога пропускаем дольше
+_BREAKER_COOLDOWN_SEC = 60.0
+_BREAKER_THRESHOLD = 0.1
+
+# Параметры backoff при повторных попытках: экспонента с полным джиттером,
+# чтобы параллельные клиенты не повторяли запросы синхронно (thundering herd)
+_BACKOFF_BASE_SEC = 1.0
+_BACKOFF_CAP_SEC = 32.0
+
+# RetryInfo из JSON тела ошибки Gemini: error.details[].retryDelay = "12s"
+_RETRY_DELAY_RE = re.compile(r'"retryDelay"\s*:\s*"(\d+(?:\.\d+)?)s"')
+
+# Классификация ошибок API: один скомпилированный альтернационный паттерн
+# на категорию вместо 3-7 последовательных substring-проходов по телу ответа
+_QUOTA_RE = re.compile(r'quota|exceeded|billing')
+_OVERLOAD_RE = re.compile(
+    r'overload(?:ed)?|too many requests|rate limit|service unavailable'
+    r'|temporarily unavailable|try again later'
+)
+_MODEL_ERROR_RE = re.compile(r'not found|not supported')
+
+# Быстрое извлечение нужных полей из structured-ответа без полного JSON-парса —
+# применяется, когда вызывающему не нужно длинное поле reasoning
+_SELECTED_INDEX_RE = re.compile(r'"selected_index"\s*:\s*(\d+)')
+_CONFIDENCE_RE = re.compile(r'"confidence"\s*:\s*([0-9.]+)')
+# Потоковые варианты: SSE-чанк может разрезать число посередине
+# ("selected_index": 1 + "2" в следующем событии), поэтому выходим из
+# потока только когда за числом уже виден JSON-терминатор
+_SELECTED_INDEX_DONE_RE = re.compile(r'"selected_index"\s*:\s*(\d+)\s*[,}]')
+_CONFIDENCE_DONE_RE = re.compile(r'"confidence"\s*:\s*([0-9.]+)\s*[,}]')
+
+# Промпт и схема для батч-режима: несколько запросов в одном LLM вызове,
+# ответ — JSON-массив решений (по одному на запрос)
+_CHOOSE_MULTI_PROMPT = """Ты христианский эксперт. Для КАЖДОГО запроса пользователя ниже выбери лучшую христианскую песню из его списка кандидатов.
+
+{tasks}
+
+Верни JSON-массив ровно из {count} решений — по одному на каждый запрос, в том же порядке. В каждом решении укажи query_index (номер запроса, 1-based), selected_index (номер выбранной песни из кандидатов этого запроса, 1-based), reasoning и confidence."""
+
+_CHOOSE_MULTI_ITEM_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "query_index": {
+            "type": "integer",
+            "description": "Номер запроса (1-based)"
+        },
+        "selected_index": {
+            "type": "integer",
+            "description": "Номер выбранной песни (1-based)"
+        },
+        "reasoning": {
+            "type": "string",
+            "description": "Объяснение выбора для этого запроса"
+        },
+        "confidence": {
+            "type": "number",
+            "description": "Уверенность в выборе от 0 до 1"
+        }
+    },
+    "required": ["query_index", "selected_index", "reasoning"]
+}
 
 
 class SongSelector:
     """Класс для выбора лучшей песни из кандидатов через LLM."""
-    
-    def __init__(self, api_key: str = None, model: str = "gemini-2.5-flash-lite", fallback_models: List[str] = None, max_retries: int = 2):
+
+    # Паттерны разбора текстового ответа ("ВЫБОР: 1", "1." и т.п.) для
+    # _parse_selection, скомпилированные один раз при загрузке класса.
+    # Три регистровых варианта "ВЫБОР" покрываются флагом IGNORECASE.
+    _CHOICE_PATTERNS = [
+        re.compile(r'ВЫБОР:\s*(\d+)', re.IGNORECASE | re.MULTILINE),
+        re.compile(r'^(\d+)\.', re.IGNORECASE | re.MULTILINE),
+    ]
+    _NUM_PATTERN = re.compile(r'\b(\d+)\b')
+
+    def __init__(self, api_key: str = None, model: str = "gemini-2.5-flash-lite", fallback_models: List[str] = None, max_retries: int = 2, top_k: int = 10, cache_backend=None):
         """
         Инициализация селектора песен.
-        
+
         Args:
             api_key: Google API ключ. Если не указан, берётся из переменной окружения GOOGLE_API_KEY.
             model: Модель LLM для использования (по умолчанию gemini-2.5-flash)
             fallback_models: Список резервных моделей для автоматического переключения при ошибках
             max_retries: Максимальное количество повторных попыток для одной модели при перегрузке
+            top_k: Сколько верхних кандидатов отдавать в промпт (0 = без ограничения).
+                   Кандидаты приходят уже отранжированными поиском, поэтому
+                   обрезка хвоста почти не теряет качества, но режет токены.
+            cache_backend: Персистентный ярус кэша решений (например, SqliteBackend)
+                           позади in-proc LRU. None = только кэш в памяти.
         """
         self.api_key = api_key or os.getenv("GOOGLE_API_KEY")
         if not self.api_key:
@@ -31,6 +394,7 @@ class SongSelector:
         
         self.model = model
         self.max_retries = max_retries
+        self.top_k = top_k
         # Резервные модели по умолчанию (от быстрых к более мощным)
         # Убраны недоступные модели: gemini-1.5-flash, gemini-1.5-pro (404 ошибка)
         if fallback_models is None:
@@ -48,31 +412,277 @@ class SongSelector:
         
         # Убедимся, что основная модель в списке для попыток
         self.models_to_try = [self.model] + [m for m in self.fallback_models if m != self.model]
-        self.api_url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent"
+        # URL каждой модели строится один раз, а не f-string'ом в горячем цикле
+        self._model_urls = {
+            m: f"{_API_BASE}/{m}:generateContent" for m in self.models_to_try
+        }
+        self.api_url = self._model_url(model)
         
         # Храним последнюю успешную модель для приоритетного использования в следующих запросах
         self.last_successful_model = None
-    
+
+        # Файловый кэш здоровья моделей: последняя успешная модель и cooldown'ы
+        # перегруженных моделей переживают перезапуск процесса, чтобы первый
+        # запрос после рестарта не тратил попытки на заведомо недоступные модели
+        self._health_path = os.path.join(
+            os.path.expanduser("~"), ".cache", "song_selector", "health.json"
+        )
+        self._model_cooldown: Dict[str, float] = {}  # model -> unix ts, до которого модель пропускаем
+        # Снимок последнего сохранённого состояния — чтобы не писать файл,
+        # когда сохранять нечего (устоявшийся режим с одной рабочей моделью)
+        self._saved_health = None
+        # Модели, ответившие 404/not found — мёртвые до конца жизни процесса,
+        # чтобы не тратить запрос на них при каждом вызове
+        self._dead_models: set = set()
+        self._load_health()
+
+        # Кэш ответов LLM (см. _cache_key): экономит полный сетевой round-trip
+        # на повторных запросах с тем же набором кандидатов.
+        # cache_backend — второй, персистентный ярус позади LRU: переживает
+        # рестарты и разделяется между воркерами
+        self._llm_cache = _LLMCache()
+        self._cache_backend = cache_backend
+
+        # Кэш отформатированных блоков песен для промпта (без номера):
+        # одни и те же кандидаты между запросами не форматируются заново
+        self._fmt_cache: Dict[str, str] = {}
+
+        # Кэш результатов enhance_query: популярные запросы повторяются,
+        # повторное улучшение не стоит API-вызова
+        self._enhance_cache = _LLMCache(maxsize=1024)
+
+        # Общая aiohttp-сессия для всех асинхронных вызовов: соединения
+        # и TLS-handshake переиспользуются между запросами и батчами
+        self._session: aiohttp.ClientSession = None
+
+        # Общая requests.Session для синхронных вызовов — keep-alive
+        # избавляет каждый retry/fallback от нового TLS-handshake
+        self._http = requests.Session()
+
+        # Single-flight: конкурентные дубликаты одного запроса (одинаковый
+        # ключ кэша) ждут общий Future вместо параллельных вызовов API
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+        # Общий token bucket на все асинхронные вызовы: квота Gemini
+        # "запросы в минуту", поэтому 60 токенов с пополнением 1/сек
+        self._bucket = _TokenBucket(capacity=60.0, refill_per_sec=1.0)
+
+        # Скользящая статистика моделей: model -> (ewma_success, ewma_latency).
+        # Используется для сортировки моделей по здоровью и circuit breaker'а
+        self._model_stats: Dict[str, Tuple[float, float]] = {}
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Возвращает общую aiohttp-сессию, создавая её при первом обращении."""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=1000,
+                    limit_per_host=1000,
+                    ttl_dns_cache=300,
+                    keepalive_timeout=75,
+                ),
+                timeout=aiohttp.ClientTimeout(total=60),
+            )
+        return self._session
+
+    async def close(self):
+        """Закрывает общую aiohttp-сессию (если была создана)."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def _compute_backoff(self, retry: int, response=None) -> float:
+        """
+        Считает паузу перед повторной попыткой.
+        Сначала уважаем Retry-After / retryDelay из ответа API, иначе
+        экспоненциальный backoff с полным джиттером (cap 32 сек).
+
+        Args:
+            retry: Номер повторной попытки (0-based)
+            response: Ответ API, вызвавший повтор (requests.Response или _ResponseView)
+
+        Returns:
+            Время ожидания в секундах
+        """
+        if response is not None:
+            headers = getattr(response, "headers", None)
+            retry_after = headers.get("Retry-After") if headers else None
+            if retry_after:
+                try:
+                    return min(float(retry_after), _BACKOFF_CAP_SEC)
+                except ValueError:
+                    pass
+            delay_match = _RETRY_DELAY_RE.search(getattr(response, "text", "") or "")
+            if delay_match:
+                try:
+                    return min(float(delay_match.group(1)), _BACKOFF_CAP_SEC)
+                except ValueError:
+                    pass
+
+        return random.uniform(0.0, min(_BACKOFF_CAP_SEC, _BACKOFF_BASE_SEC * (2 ** retry)))
+
+    def _cache_key(self, user_query: str, candidates: List[Dict[str, Any]], return_reasoning: bool) -> str:
+        """
+        Ключ кэша ответов LLM. Включает набор кандидатов и модель,
+        чтобы одинаковый текст запроса с другой выдачей поиска
+        не дал ложного попадания.
+        """
+        cand_ids = sorted(str(c.get("id") or c.get("title") or "") for c in candidates)
+        raw = json.dumps(
+            {
+                "query": user_query,
+                "cand_ids": cand_ids,
+                "model": self.model,
+                "reasoning": return_reasoning,
+            },
+            ensure_ascii=False, sort_keys=True
+        )
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _cache_get(self, cache_key: str) -> Optional[Dict[str, Any]]:
+        """
+        Двухъярусный поиск в кэше: сначала in-proc LRU, затем персистентный
+        бэкенд. Попадание во втором ярусе прогревает первый.
+        """
+        cached = self._llm_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        if self._cache_backend is not None:
+            try:
+                cached = self._cache_backend.get(cache_key)
+            except Exception as e:
+                logger.warning("Ошибка чтения персистентного кэша: %s", e)
+                return None
+            if cached is not None:
+                self._llm_cache.set(cache_key, cached)
+        return cached
+
+    def _cache_set(self, cache_key: str, result: Dict[str, Any]):
+        """Кладёт результат в оба яруса кэша."""
+        self._llm_cache.set(cache_key, result)
+        if self._cache_backend is not None:
+            try:
+                self._cache_backend.set(cache_key, result)
+            except Exception as e:
+                logger.warning("Ошибка записи персистентного кэша: %s", e)
+
+    def _model_url(self, model_name: str) -> str:
+        """Возвращает кэшированный URL generateContent для модели."""
+        url = self._model_urls.get(model_name)
+        if url is None:
+            url = f"{_API_BASE}/{model_name}:generateContent"
+            self._model_urls[model_name] = url
+        return url
+
+    def _load_health(self):
+        """Загружает сохранённое состояние моделей с диска (если есть)."""
+        try:
+            with open(self._health_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return  # Нет кэша или он повреждён — начинаем с чистого состояния
+
+        last = data.get("last_successful_model")
+        if last in self.models_to_try:
+            self.last_successful_model = last
+
+        now = time.time()
+        cooldown = data.get("model_cooldown", {})
+        if isinstance(cooldown, dict):
+            self._model_cooldown = {
+                m: until for m, until in cooldown.items()
+                if isinstance(until, (int, float)) and until > now
+            }
+
+    def _save_health(self):
+        """
+        Атомарно сохраняет состояние моделей на диск.
+        Вызывается на каждом успешном LLM-вызове, поэтому при неизменном
+        состоянии (та же модель, те же cooldown'ы) запись пропускается —
+        файловый I/O на горячем пути остаётся только для реальных смен.
+        """
+        state = (
+            self.last_successful_model,
+            tuple(sorted(self._model_cooldown.items())),
+        )
+        if state == self._saved_health:
+            return
+        try:
+            os.makedirs(os.path.dirname(self._health_path), exist_ok=True)
+            tmp_path = self._health_path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    "last_successful_model": self.last_successful_model,
+                    "model_cooldown": self._model_cooldown,
+                }, f, ensure_ascii=False)
+            os.replace(tmp_path, self._health_path)
+            self._saved_health = state
+        except OSError:
+            pass  # Кэш здоровья не критичен для работы
+
+    def _song_fingerprint(self, song: Dict[str, Any]) -> str:
+        """
+        Стабильный ключ песни для кэша форматирования: id, если он есть,
+        иначе md5 от названия и начала текста.
+
+        Args:
+            song: Словарь с данными песни
+
+        Returns:
+            Строковый ключ песни
+        """
+        song_id = song.get("id")
+        if song_id is not None:
+            return str(song_id)
+        lyrics = song.get("lyrics") or ""
+        if isinstance(lyrics, list):
+            lyrics = lyrics[0] if lyrics else ""
+        raw = f"{song.get('title', '')}|{str(lyrics)[:64]}"
+        return hashlib.md5(raw.encode('utf-8')).hexdigest()
+
     def _format_song_info(self, song: Dict[str, Any], index: int) -> str:
         """
         Форматирует информацию о песне для промпта.
-        
+        Блок без номера кэшируется по ключу песни: одна и та же песня
+        в кандидатах разных запросов форматируется один раз, а номер
+        (единственная переменная часть) подставляется при вызове.
+
         Args:
             song: Словарь с данными песни
             index: Индекс песни в списке
-            
+
         Returns:
             Отформатированная строка с информацией о песне
         """
-        info = f"\n{index}. "
-        
+        fingerprint = self._song_fingerprint(song)
+        cached = self._fmt_cache.get(fingerprint)
+        if cached is not None:
+            return f"\n{index}. {cached}"
+
+        info = ""
+
         if song.get("title"):
             info += f"Название: {song['title']}"
         if song.get("lyrics"):
             lyrics = song["lyrics"]
-            # Обработка lyrics - может быть строкой или массивом
+            # Обработка lyrics - может быть строкой или массивом.
+            # Лимит всё равно 300 символов, поэтому из массива набираем строки
+            # только до лимита, не склеивая весь текст целиком
             if isinstance(lyrics, list):
-                lyrics = "\n".join(lyrics)
+                buf = []
+                total = 0
+                for line in lyrics:
+                    buf.append(line)
+                    total += len(line) + 1  # +1 за перевод строки при склейке
+                    if total >= 300:
+                        break
+                lyrics = "\n".join(buf)
             # Ограничиваем длину текста
             if len(lyrics) > 300:
                 lyrics = lyrics[:300] + "..."
@@ -87,80 +697,138 @@ class SongSelector:
             if isinstance(mood, str):
                 mood = [mood]
             info += f"\n   Настроение: {', '.join(mood)}"
-        
-        return info
+
+        # Сохраняем блок без номера (ограничиваем размер кэша, как в
+        # кэше embeddings запросов — FIFO до 1000 записей)
+        if len(self._fmt_cache) >= 1000:
+            oldest_key = next(iter(self._fmt_cache))
+            del self._fmt_cache[oldest_key]
+        self._fmt_cache[fingerprint] = info
+
+        return f"\n{index}. {info}"
     
-    def _is_quota_error(self, response: requests.Response) -> bool:
+    def _classify_error(self, response) -> str:
         """
-        Проверяет, является ли ошибка ошибкой превышения квоты (не перегрузка).
-        
+        Классифицирует ошибку API по структурированному телу ответа.
+        Gemini возвращает JSON {"error": {"status", "code", "message"}} —
+        один разбор вместо нескольких substring-сканов по всему телу
+        (и без ложных срабатываний, когда "overloaded" упомянут в тексте
+        ошибки другого типа).
+
         Args:
-            response: Ответ от API
-            
+            response: Ответ от API (requests.Response или _ResponseView)
+
         Returns:
-            True, если это ошибка квоты
+            "quota" (превышена квота), "overload" (временная перегрузка),
+            "model" (модель не найдена/не поддерживается) или "other"
         """
-        error_text = response.text.lower()
-        status_code = response.status_code
-        
-        return (
-            status_code == 429 and (
-                "quota" in error_text or
-                "exceeded" in error_text or
-                "billing" in error_text
-            )
-        )
-    
-    def _is_overload_error(self, response: requests.Response) -> bool:
+        try:
+            error = orjson.loads(response.text)["error"]
+            status = error["status"]
+            message = error.get("message", "")
+        except (ValueError, KeyError, TypeError):
+            # Тело не структурировано — откатываемся на статус-код и регэкспы
+            error_text = response.text.lower()
+            if response.status_code == 429:
+                return "quota" if _QUOTA_RE.search(error_text) else "overload"
+            if response.status_code in (500, 503) or _OVERLOAD_RE.search(error_text):
+                return "overload"
+            if response.status_code == 404 or _MODEL_ERROR_RE.search(error_text):
+                return "model"
+            return "other"
+
+        if status == "RESOURCE_EXHAUSTED":
+            # 429: исчерпание квоты и rate limit различаются текстом сообщения
+            return "quota" if _QUOTA_RE.search(message.lower()) else "overload"
+        if status in ("UNAVAILABLE", "INTERNAL", "DEADLINE_EXCEEDED"):
+            return "overload"
+        if status == "NOT_FOUND":
+            return "model"
+        if status == "INVALID_ARGUMENT" and "model" in message.lower():
+            return "model"
+        return "other"
+
+
+    def _record_result(self, model_name: str, success: bool, latency: float = None):
         """
-        Проверяет, является ли ошибка ошибкой перегрузки модели (временная).
-        
+        Обновляет скользящую статистику модели (EWMA, вес новой точки 0.1).
+        Модель, которая стабильно падает, получает длинный cooldown
+        (circuit breaker), чтобы не тратить на неё попытки весь плохой день.
+
         Args:
-            response: Ответ от API
-            
+            model_name: Имя модели
+            success: Успешен ли был запрос
+            latency: Длительность запроса в секундах (если замерена)
+        """
+        ewma_success, ewma_latency = self._model_stats.get(model_name, (1.0, 0.0))
+        ewma_success = 0.9 * ewma_success + 0.1 * (1.0 if success else 0.0)
+        if latency is not None:
+            ewma_latency = 0.9 * ewma_latency + 0.1 * latency if ewma_latency else latency
+        self._model_stats[model_name] = (ewma_success, ewma_latency)
+
+        if ewma_success < _BREAKER_THRESHOLD:
+            self._model_cooldown[model_name] = time.time() + _BREAKER_COOLDOWN_SEC
+
+    def _models_for_attempt(self) -> List[str]:
+        """
+        Формирует список моделей для попыток: здоровые по скользящему success
+        rate (при равенстве — более быстрые) первыми, последняя успешная — в
+        приоритете. Мёртвые (404) исключаются совсем, модели в cooldown
+        пропускаются, если есть хоть одна доступная.
+
         Returns:
-            True, если это ошибка перегрузки
+            Упорядоченный список имён моделей
+
+        Raises:
+            Exception: Если все модели мёртвые
         """
-        error_text = response.text.lower()
-        status_code = response.status_code
-        
-        # 429 без quota - это rate limit (перегрузка)
-        # 503, 500 - перегрузка сервера
-        is_overload_status = status_code in [503, 500] or (status_code == 429 and not self._is_quota_error(response))
-        
-        # Проверяем текст ошибки
-        is_overload_text = (
-            "overloaded" in error_text or
-            "overload" in error_text or
-            "too many requests" in error_text or
-            "rate limit" in error_text or
-            "service unavailable" in error_text or
-            "temporarily unavailable" in error_text or
-            "try again later" in error_text
+        stats = self._model_stats
+        models = sorted(
+            self.models_to_try,
+            key=lambda m: (-stats.get(m, (1.0, 0.0))[0], stats.get(m, (1.0, 0.0))[1])
         )
-        
-        return is_overload_status or is_overload_text
-    
-    def _is_model_error(self, response: requests.Response) -> bool:
+        if self.last_successful_model in models:
+            models.remove(self.last_successful_model)
+            models.insert(0, self.last_successful_model)
+
+        # Мёртвые модели (404) не пробуем до конца жизни процесса
+        if self._dead_models:
+            models = [m for m in models if m not in self._dead_models]
+            if not models:
+                raise Exception(
+                    f"Все модели недоступны (404): {', '.join(sorted(self._dead_models))}"
+                )
+
+        # Пропускаем модели, у которых ещё не истёк cooldown
+        # (если под cooldown попали все — пробуем всё равно весь список)
+        now = time.time()
+        available_models = [m for m in models if self._model_cooldown.get(m, 0) <= now]
+        return available_models or models
+
+    def _error_view(self, response: requests.Response) -> _ResponseView:
         """
-        Проверяет, является ли ошибка ошибкой модели (не найдена, не поддерживается).
-        
+        Читает не больше _ERROR_BODY_CAP байт тела ошибки (запросы идут со
+        stream=True) и оборачивает в _ResponseView: память на пути ошибки
+        ограничена константой, а не размером тела ответа.
+
         Args:
-            response: Ответ от API
-            
+            response: Ответ requests с ошибочным статусом
+
         Returns:
-            True, если это ошибка модели
+            _ResponseView с усечённым текстом ошибки
         """
-        error_text = response.text.lower()
-        status_code = response.status_code
-        
-        return (
-            status_code == 404 or
-            "not found" in error_text or
-            "not supported" in error_text or
-            ("model" in error_text and ("not found" in error_text or "not supported" in error_text))
+        try:
+            error_bytes = response.raw.read(_ERROR_BODY_CAP, decode_content=True)
+        except Exception:
+            error_bytes = b""
+        finally:
+            response.close()
+        return _ResponseView(
+            response.status_code,
+            error_bytes.decode('utf-8', 'replace'),
+            response.headers
         )
-    
+
     def _try_request_with_fallback(self, payload: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any]:
         """
         Пытается выполнить запрос к API, переключаясь между моделями при ошибках.
@@ -179,62 +847,72 @@ class SongSelector:
             Exception: Если все модели недоступны
         """
         last_error = None
-        
-        # Формируем список моделей для попыток с приоритетом последней успешной
-        models_to_try = []
-        if self.last_successful_model and self.last_successful_model in self.models_to_try:
-            # Начинаем с последней успешной модели
-            models_to_try.append(self.last_successful_model)
-            # Добавляем остальные модели, исключая уже добавленную
-            models_to_try.extend([m for m in self.models_to_try if m != self.last_successful_model])
-        else:
-            # Если нет последней успешной модели, используем стандартный порядок
-            models_to_try = self.models_to_try
-        
+
+        # Модели в порядке здоровья: последняя успешная, затем по success rate
+        models_to_try = self._models_for_attempt()
+
+        # Кодируем тело один раз на все попытки (msgspec быстрее stdlib json);
+        # горячие пути передают уже готовые bytes
+        body = payload if isinstance(payload, bytes) else _JSON_ENCODER.encode(payload)
+
         # Сначала пробуем все модели один раз
         overloaded_models = []  # Модели, которые перегружены
         quota_exceeded_models = []  # Модели, у которых превышена квота
         for model_name in models_to_try:
             try:
-                api_url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent"
-                response = requests.post(api_url, headers=headers, json=payload)
-                
+                api_url = self._model_url(model_name)
+                started = time.monotonic()
+                response = self._http.post(api_url, headers=headers, data=body, stream=True)
+
                 if response.status_code == 200:
                     # Успешный запрос - сохраняем модель для следующего запроса
+                    content = response.content
+                    self._record_result(model_name, True, time.monotonic() - started)
                     self.last_successful_model = model_name
+                    self._model_cooldown.pop(model_name, None)
+                    self._save_health()
                     if model_name != self.model:
-                        print(f"  ⚠️  Переключился на модель: {model_name}")
-                    return response.json()
-                
+                        logger.warning("Переключился на модель: %s", model_name)
+                    return orjson.loads(content)
+
+                # Тело ошибки читаем с ограничением: для классификации хватает начала
+                view = self._error_view(response)
+                self._record_result(model_name, False)
+
                 # Обработка ошибок
-                if self._is_quota_error(response):
+                error_kind = self._classify_error(view)
+                if error_kind == "quota":
                     # Превышена квота для этой модели - пробуем следующую
-                    quota_exceeded_models.append((model_name, response))
-                    print(f"  ⚠️  Модель {model_name} превысила квоту, пробуем следующую...")
-                    last_error = f"{response.status_code}: Превышена квота для {model_name}"
+                    quota_exceeded_models.append((model_name, view))
+                    logger.warning("Модель %s превысила квоту, пробуем следующую...", model_name)
+                    last_error = f"{view.status_code}: Превышена квота для {model_name}"
                     continue
-                
-                elif self._is_overload_error(response):
+
+                elif error_kind == "overload":
                     # Модель перегружена - сохраняем для повторных попыток позже
-                    overloaded_models.append((model_name, response))
-                    print(f"  ⏳ Модель {model_name} перегружена, пробуем следующую...")
+                    # и ставим cooldown, чтобы следующие запросы её не трогали
+                    overloaded_models.append((model_name, view))
+                    self._model_cooldown[model_name] = time.time() + _OVERLOAD_COOLDOWN_SEC
+                    logger.warning("Модель %s перегружена, пробуем следующую...", model_name)
                     continue
-                
-                elif self._is_model_error(response):
-                    # Ошибка модели (не найдена, не поддерживается) - пропускаем
-                    last_error = f"{response.status_code}: {response.text[:200]}"
-                    print(f"  ⚠️  Модель {model_name} недоступна, пробуем следующую...")
+
+                elif error_kind == "model":
+                    # Ошибка модели (не найдена, не поддерживается) -
+                    # запоминаем как мёртвую и больше не пробуем
+                    self._dead_models.add(model_name)
+                    last_error = f"{view.status_code}: {view.text[:200]}"
+                    logger.warning("Модель %s недоступна, больше не пробуем...", model_name)
                     continue
-                
+
                 else:
                     # Другая ошибка (авторизация и т.д.) - пробрасываем
-                    error_msg = response.text[:500] if len(response.text) > 500 else response.text
-                    raise Exception(f"{response.status_code}: {error_msg}")
+                    raise Exception(f"{view.status_code}: {view.text[:500]}")
                     
             except requests.exceptions.RequestException as e:
                 # Сетевая ошибка - пропускаем эту модель
+                self._record_result(model_name, False)
                 last_error = str(e)
-                print(f"  ⚠️  Сетевая ошибка для {model_name}, пробуем следующую модель...")
+                logger.warning("Сетевая ошибка для %s, пробуем следующую модель...", model_name)
                 continue
         
         # Если все модели превысили квоту (и нет перегруженных) - пробрасываем ошибку
@@ -244,28 +922,31 @@ class SongSelector:
         
         # Если все модели перегружены, делаем повторные попытки
         if overloaded_models:
-            print(f"  ⚠️  Все модели перегружены, делаем повторные попытки...")
+            logger.warning("Все модели перегружены, делаем повторные попытки...")
             for retry in range(self.max_retries):
-                wait_time = (retry + 1) * 2  # Экспоненциальная задержка: 2, 4, 6 секунд
-                print(f"  ⏳ Повторная попытка через {wait_time} сек... (попытка {retry + 1}/{self.max_retries})")
+                wait_time = self._compute_backoff(retry, overloaded_models[0][1])
+                logger.warning("Повторная попытка через %.1f сек... (попытка %d/%d)", wait_time, retry + 1, self.max_retries)
                 time.sleep(wait_time)
                 
                 # Пробуем все перегруженные модели снова
                 for model_name, _ in overloaded_models:
                     try:
-                        api_url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent"
-                        response = requests.post(api_url, headers=headers, json=payload)
-                        
+                        api_url = self._model_url(model_name)
+                        response = self._http.post(api_url, headers=headers, data=body, stream=True)
+
                         if response.status_code == 200:
+                            content = response.content
                             self.last_successful_model = model_name
+                            self._model_cooldown.pop(model_name, None)
+                            self._save_health()
                             if model_name != self.model:
-                                print(f"  ⚠️  Переключился на модель: {model_name}")
-                            return response.json()
-                        
-                        if not self._is_overload_error(response):
+                                logger.warning("Переключился на модель: %s", model_name)
+                            return orjson.loads(content)
+
+                        view = self._error_view(response)
+                        if self._classify_error(view) != "overload":
                             # Если это не перегрузка, пробрасываем ошибку
-                            error_msg = response.text[:500] if len(response.text) > 500 else response.text
-                            raise Exception(f"{response.status_code}: {error_msg}")
+                            raise Exception(f"{view.status_code}: {view.text[:500]}")
                             
                     except requests.exceptions.RequestException as e:
                         last_error = str(e)
@@ -274,78 +955,173 @@ class SongSelector:
         # Все модели не сработали
         raise Exception(f"Все модели недоступны. Последняя ошибка: {last_error}")
     
-    def enhance_query(self, user_query: str) -> Dict[str, Any]:
+    async def _try_request_with_fallback_async(
+        self,
+        payload: Dict[str, Any],
+        headers: Dict[str, str],
+        session: aiohttp.ClientSession
+    ) -> Dict[str, Any]:
         """
-        Улучшает запрос пользователя через AI для более точного векторного поиска.
-        Определяет тему, настроение, ключевые мысли и формирует запрос, оптимизированный для поиска песен.
-        
+        Асинхронная версия _try_request_with_fallback: aiohttp вместо requests
+        и asyncio.sleep вместо time.sleep, чтобы backoff между попытками
+        не блокировал event loop и не останавливал соседние запросы.
+
         Args:
-            user_query: Исходный запрос пользователя
-            
+            payload: Тело запроса
+            headers: Заголовки запроса
+            session: aiohttp сессия
+
         Returns:
-            Словарь с:
-            - enhanced_query: Улучшенный запрос для векторного поиска
-            - theme: Основная тема запроса
-            - mood: Настроение запроса
-            - keywords: Ключевые слова/мысли
-            Или исходный запрос в enhanced_query, если произошла ошибка
+            Ответ от API в формате JSON
+
+        Raises:
+            Exception: Если все модели недоступны
         """
-        prompt = f"""Улучши запрос пользователя для поиска христианских песен. Определи тему, настроение, ключевые слова и сформируй улучшенный запрос для векторного поиска.
+        last_error = None
 
-Важно: В enhanced_query обязательно добавь синонимы и тематически близкие слова (например: осень → листья, листопад, природа, смена пор года, урожай; зима → снег, холод; весна → пробуждение, цветы). Это нужно, чтобы поиск находил песни по смыслу и по формулировкам в текстах.
+        # Модели в порядке здоровья: последняя успешная, затем по success rate
+        models_to_try = self._models_for_attempt()
 
-Примеры:
-"мне грустно" → theme: грусть/утешение, mood: грустное, keywords: одиночество/поддержка, enhanced_query: "христианская песня про грусть, печаль, одиночество, утешение, поддержку"
-"Осень, падают листья" → theme: природа/времена года, mood: размышление, keywords: осень/листья/листопад/природа, enhanced_query: "осень, падающие листья, листопад, природа, смена пор года, творение, благодарность за природу"
-"хочу спокойное для вечера" → theme: покой/размышление, mood: спокойное, keywords: вечер/тишина, enhanced_query: "спокойная христианская песня для вечера, умиротворение, тишина, покой"
+        # Кодируем тело один раз на все попытки; горячие пути передают готовые bytes
+        body = payload if isinstance(payload, bytes) else _JSON_ENCODER.encode(payload)
 
-Запрос: "{user_query}"
+        # Сначала пробуем все модели один раз
+        overloaded_models = []
+        quota_exceeded_models = []
+        for model_name in models_to_try:
+            try:
+                await self._bucket.acquire()
+                started = time.monotonic()
+                async with session.post(self._model_url(model_name), headers=headers, data=body) as response:
+                    if response.status == 200:
+                        raw = await response.read()
+                        self._record_result(model_name, True, time.monotonic() - started)
+                        self.last_successful_model = model_name
+                        self._model_cooldown.pop(model_name, None)
+                        self._save_health()
+                        if model_name != self.model:
+                            logger.warning("Переключился на модель: %s", model_name)
+                        return orjson.loads(raw)
+                    error_bytes = await response.content.read(_ERROR_BODY_CAP)
+                    view = _ResponseView(response.status, error_bytes.decode('utf-8', 'replace'), dict(response.headers))
 
-Верни ТОЛЬКО JSON без текста/комментариев/markdown:
-{{
-  "theme": "тема",
-  "mood": "настроение",
-  "keywords": "ключевые слова",
-  "enhanced_query": "улучшенный запрос с синонимами и тематическими словами"
-}}"""
+                self._record_result(model_name, False)
 
-        try:
-            headers = {
-                'Content-Type': 'application/json',
-                'X-goog-api-key': self.api_key
-            }
-            
-            payload = {
-                "contents": [{
+                # 429 означает, что реальная квота ниже — притормаживаем ведро
+                if view.status_code == 429:
+                    self._bucket.penalize()
+
+                error_kind = self._classify_error(view)
+                if error_kind == "quota":
+                    quota_exceeded_models.append((model_name, view))
+                    logger.warning("Модель %s превысила квоту, пробуем следующую...", model_name)
+                    last_error = f"{view.status_code}: Превышена квота для {model_name}"
+                    continue
+
+                elif error_kind == "overload":
+                    overloaded_models.append((model_name, view))
+                    self._model_cooldown[model_name] = time.time() + _OVERLOAD_COOLDOWN_SEC
+                    logger.warning("Модель %s перегружена, пробуем следующую...", model_name)
+                    continue
+
+                elif error_kind == "model":
+                    self._dead_models.add(model_name)
+                    last_error = f"{view.status_code}: {view.text[:200]}"
+                    logger.warning("Модель %s недоступна, больше не пробуем...", model_name)
+                    continue
+
+                else:
+                    error_msg = view.text[:500]
+                    raise Exception(f"{view.status_code}: {error_msg}")
+
+            except aiohttp.ClientError as e:
+                self._record_result(model_name, False)
+                last_error = str(e)
+                logger.warning("Сетевая ошибка для %s, пробуем следующую модель...", model_name)
+                continue
+
+        # Если все модели превысили квоту (и нет перегруженных) - пробрасываем ошибку
+        if quota_exceeded_models and not overloaded_models:
+            error_msg = f"Превышена квота для всех моделей: {', '.join([m[0] for m in quota_exceeded_models])}"
+            raise Exception(error_msg)
+
+        # Если все модели перегружены, делаем повторные попытки
+        if overloaded_models:
+            logger.warning("Все модели перегружены, делаем повторные попытки...")
+            for retry in range(self.max_retries):
+                wait_time = self._compute_backoff(retry, overloaded_models[0][1])
+                logger.warning("Повторная попытка через %.1f сек... (попытка %d/%d)", wait_time, retry + 1, self.max_retries)
+                await asyncio.sleep(wait_time)
+
+                for model_name, _ in overloaded_models:
+                    try:
+                        await self._bucket.acquire()
+                        async with session.post(self._model_url(model_name), headers=headers, data=body) as response:
+                            if response.status == 200:
+                                self.last_successful_model = model_name
+                                self._model_cooldown.pop(model_name, None)
+                                self._save_health()
+                                if model_name != self.model:
+                                    logger.warning("Переключился на модель: %s", model_name)
+                                return orjson.loads(await response.read())
+                            error_bytes = await response.content.read(_ERROR_BODY_CAP)
+                            view = _ResponseView(response.status, error_bytes.decode('utf-8', 'replace'), dict(response.headers))
+
+                        if self._classify_error(view) != "overload":
+                            error_msg = view.text[:500]
+                            raise Exception(f"{view.status_code}: {error_msg}")
+
+                    except aiohttp.ClientError as e:
+                        last_error = str(e)
+                        continue
+
+        # Все модели не сработали
+        raise Exception(f"Все модели недоступны. Последняя ошибка: {last_error}")
+
+    def is_enhance_cached(self, user_query: str) -> bool:
+        """
+        Проверяет (не трогая LRU-порядок), есть ли улучшение запроса в кэше.
+        Используется веб-слоем для заголовка X-Cache.
+        """
+        cache_key = hashlib.sha256(user_query.encode('utf-8')).hexdigest()
+        return cache_key in self._enhance_cache
+
+    def enhance_query(self, user_query: str) -> Dict[str, Any]:
+        """
+        Улучшает запрос пользователя через AI для более точного векторного поиска.
+        Определяет тему, настроение, ключевые мысли и формирует запрос, оптимизированный для поиска песен.
+        
+        Args:
+            user_query: Исходный запрос пользователя
+            
+        Returns:
+            Словарь с:
+            - enhanced_query: Улучшенный запрос для векторного поиска
+            - theme: Основная тема запроса
+            - mood: Настроение запроса
+            - keywords: Ключевые слова/мысли
+            Или исходный запрос в enhanced_query, если произошла ошибка
+        """
+        # Популярные запросы повторяются — отдаём улучшение из кэша
+        # без round-trip к API
+        cache_key = hashlib.sha256(user_query.encode('utf-8')).hexdigest()
+        cached = self._enhance_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        prompt = _ENHANCE_PROMPT.format(query=user_query)
+
+        try:
+            headers = {
+                'Content-Type': 'application/json',
+                'X-goog-api-key': self.api_key
+            }
+            
+            payload = {
+                "contents": [{
                     "parts": [{"text": prompt}]
                 }],
-                "generationConfig": {
-                    "temperature": 0.3,  # Низкая температура для более детерминированного результата
-                    "maxOutputTokens": 300,
-                    "responseMimeType": "application/json",
-                    "responseSchema": {
-                        "type": "object",
-                        "properties": {
-                            "theme": {
-                                "type": "string",
-                                "description": "Основная тема запроса"
-                            },
-                            "mood": {
-                                "type": "string",
-                                "description": "Настроение запроса"
-                            },
-                            "keywords": {
-                                "type": "string",
-                                "description": "Ключевые слова через запятую"
-                            },
-                            "enhanced_query": {
-                                "type": "string",
-                                "description": "Улучшенный запрос для векторного поиска"
-                            }
-                        },
-                        "required": ["theme", "mood", "keywords", "enhanced_query"]
-                    }
-                }
+                "generationConfig": _ENHANCE_GEN_CONFIG
             }
             
             # Используем механизм fallback моделей, но с меньшим количеством попыток
@@ -360,54 +1136,54 @@ class SongSelector:
             last_error = None
             for model_name in fast_models:
                 try:
-                    api_url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent"
-                    response = requests.post(api_url, headers=headers, json=payload, timeout=10)
+                    api_url = self._model_url(model_name)
+                    response = self._http.post(api_url, headers=headers, json=payload, timeout=10)
                     
                     if response.status_code == 200:
-                        result = response.json()
+                        result = orjson.loads(response.content)
                         response_text = result["candidates"][0]["content"]["parts"][0]["text"].strip()
                         
                         # Парсим JSON ответ
                         try:
-                            # Пытаемся извлечь JSON из текста (если есть markdown код блоки или префикс)
-                            json_text = response_text
-                            
-                            # Убираем markdown код блоки, если есть
-                            if "```json" in json_text:
-                                json_text = json_text.split("```json")[1].split("```")[0].strip()
-                            elif "```" in json_text:
-                                json_text = json_text.split("```")[1].split("```")[0].strip()
-                            
-                            # Убираем префиксы типа "Here is the JSON requested:"
-                            lines = json_text.split('\n')
-                            json_start = 0
-                            for i, line in enumerate(lines):
-                                if line.strip().startswith('{'):
-                                    json_start = i
-                                    break
-                            json_text = '\n'.join(lines[json_start:]).strip()
-                            
-                            parsed = json.loads(json_text)
+                            try:
+                                # Быстрый путь: с responseMimeType=application/json ответ
+                                # обычно сразу валидный JSON — без сканирования текста
+                                parsed = orjson.loads(response_text)
+                            except ValueError:
+                                # Медленный путь: убираем markdown код блоки и префиксы
+                                # типа "Here is the JSON requested:"
+                                json_text = response_text
+                                if "```json" in json_text:
+                                    json_text = json_text.split("```json")[1].split("```")[0].strip()
+                                elif "```" in json_text:
+                                    json_text = json_text.split("```")[1].split("```")[0].strip()
+                                brace_pos = json_text.find('{')
+                                if brace_pos > 0:
+                                    json_text = json_text[brace_pos:]
+                                parsed = orjson.loads(json_text)
+
                             enhanced_query = parsed.get("enhanced_query", "").strip()
-                            
+
                             # Валидация: проверяем, что enhanced_query не содержит служебного текста
                             if not enhanced_query or enhanced_query == user_query:
                                 enhanced_query = user_query
                             elif len(enhanced_query) > 500:  # Слишком длинный - вероятно, весь ответ модели
                                 enhanced_query = user_query
-                            elif "here is" in enhanced_query.lower() or "json" in enhanced_query.lower()[:50]:
+                            elif _ENHANCED_BAD_RE.search(enhanced_query):
                                 # Содержит служебный текст - используем исходный запрос
                                 enhanced_query = user_query
                             
-                            return {
+                            enhanced = {
                                 "enhanced_query": enhanced_query,
                                 "theme": parsed.get("theme", "").strip(),
                                 "mood": parsed.get("mood", "").strip(),
                                 "keywords": parsed.get("keywords", "").strip()
                             }
-                        except (json.JSONDecodeError, KeyError, IndexError) as e:
+                            self._enhance_cache.set(cache_key, enhanced)
+                            return enhanced
+                        except (ValueError, KeyError, IndexError) as e:
                             # Если не удалось распарсить, возвращаем исходный запрос
-                            print(f"⚠️ Не удалось распарсить ответ модели: {e}")
+                            logger.warning("Не удалось распарсить ответ модели: %s", e)
                             return {
                                 "enhanced_query": user_query,
                                 "theme": "",
@@ -423,7 +1199,7 @@ class SongSelector:
                     continue
             
             # Если все модели не сработали, возвращаем исходный запрос
-            print(f"⚠️ Ошибка при улучшении запроса: {last_error}, используем исходный запрос")
+            logger.warning("Ошибка при улучшении запроса: %s, используем исходный запрос", last_error)
             return {
                 "enhanced_query": user_query,
                 "theme": "",
@@ -433,7 +1209,7 @@ class SongSelector:
                 
         except Exception as e:
             # В случае любой ошибки возвращаем исходный запрос
-            print(f"⚠️ Ошибка при улучшении запроса: {e}, используем исходный запрос")
+            logger.warning("Ошибка при улучшении запроса: %s, используем исходный запрос", e)
             return {
                 "enhanced_query": user_query,
                 "theme": "",
@@ -441,9 +1217,103 @@ class SongSelector:
                 "keywords": ""
             }
     
+    def _build_choose_prompt(self, user_query: str, candidates: List[Dict[str, Any]]) -> str:
+        """
+        Собирает промпт выбора песни. Общий для choose_best и choose_best_async.
+
+        Args:
+            user_query: Запрос пользователя
+            candidates: Список кандидатов (песен)
+
+        Returns:
+            Готовый промпт
+        """
+        candidates_text = ""
+        for idx, song in enumerate(candidates, 1):
+            candidates_text += self._format_song_info(song, idx)
+        return _CHOOSE_PROMPT.format(query=user_query, candidates=candidates_text)
+
+    def _build_choose_body(self, prompt: str) -> bytes:
+        """
+        Собирает готовое к отправке тело запроса выбора песни в байтах.
+        Статические куски (systemInstruction, generationConfig со схемой)
+        предсериализованы на уровне модуля — кодируется только промпт.
+
+        Args:
+            prompt: Готовый промпт
+
+        Returns:
+            Закодированное JSON-тело запроса
+        """
+        return _CHOOSE_BODY_PREFIX + orjson.dumps(prompt) + _CHOOSE_BODY_SUFFIX
+
+    def _parse_choose_response(
+        self,
+        api_result: Dict[str, Any],
+        candidates: List[Dict[str, Any]],
+        return_reasoning: bool = True
+    ) -> Dict[str, Any]:
+        """
+        Извлекает решение из ответа API и маппит его на кандидата.
+        Общий для choose_best и choose_best_async.
+
+        Args:
+            api_result: Ответ API в формате JSON
+            candidates: Список кандидатов (песен)
+            return_reasoning: Возвращать ли объяснение выбора
+
+        Returns:
+            Словарь с выбранной песней, объяснением и уверенностью
+        """
+        response_text = api_result["candidates"][0]["content"]["parts"][0]["text"]
+
+        # Быстрый путь: если reasoning не нужен, вытаскиваем только
+        # selected_index и confidence регэкспом, не строя JSON-дерево
+        # с потенциально длинным объяснением
+        selected_index = None
+        reasoning = ""
+        confidence = 0.5
+        if not return_reasoning:
+            index_match = _SELECTED_INDEX_RE.search(response_text)
+            if index_match:
+                selected_index = int(index_match.group(1))
+                conf_match = _CONFIDENCE_RE.search(response_text)
+                if conf_match:
+                    try:
+                        confidence = float(conf_match.group(1))
+                    except ValueError:
+                        pass
+
+        if selected_index is None:
+            # Декодируем типизированно: msgspec валидирует типы полей прямо в C-декодере
+            try:
+                decision = _DECISION_DECODER.decode(response_text)
+                selected_index = decision.selected_index
+                reasoning = decision.reasoning
+                confidence = decision.confidence
+            except msgspec.DecodeError:
+                # Если JSON не распарсился, используем старый метод парсинга
+                reasoning = response_text
+                selected_index = self._parse_selection(reasoning, len(candidates))
+                confidence = 0.5
+
+        if selected_index is None or not (1 <= selected_index <= len(candidates)):
+            # Если не удалось распарсить, берём первую песню
+            selected_song = candidates[0]
+            if not reasoning:
+                reasoning = "Не удалось определить выбор автоматически. Возвращена первая найденная песня."
+        else:
+            selected_song = candidates[selected_index - 1]
+
+        return {
+            "song": selected_song,
+            "reasoning": reasoning if return_reasoning else None,
+            "confidence": confidence
+        }
+
     def choose_best(
-        self, 
-        user_query: str, 
+        self,
+        user_query: str,
         candidates: List[Dict[str, Any]],
         return_reasoning: bool = True
     ) -> Dict[str, Any]:
@@ -460,108 +1330,268 @@ class SongSelector:
         """
         if not candidates:
             raise ValueError("Список кандидатов пуст!")
-        
-        # Форматирование списка кандидатов
-        candidates_text = ""
-        for idx, song in enumerate(candidates, 1):
-            candidates_text += self._format_song_info(song, idx)
-        
-        # Создание промпта с Few-shot Learning
-        # Используем ТОЛЬКО исходный запрос пользователя для более точного понимания его намерения
-        prompt = f"""Ты христианский эксперт, выбери лучшую христианскую песню из кандидатов для запроса пользователя.
 
-Пример:
-Запрос: "Хочу спокойную песню для вечера"
-1. Тихая ночь (спокойная, умиротворённая)
-2. Утренняя радость (энергичная, радостная)
-ВЫБОР: 1
-ОБЪЯСНЕНИЕ: "Тихая ночь" подходит для вечера - спокойная и умиротворённая.
+        # Поиск уже отранжировал кандидатов — в промпт отдаём только верхние
+        # top_k, чтобы не раздувать вход модели длинным хвостом
+        if self.top_k and len(candidates) > self.top_k:
+            candidates = candidates[:self.top_k]
 
-Запрос: "{user_query}"
-Кандидаты:
-{candidates_text}
+        # Если кандидат один, выбирать не из чего — не тратим LLM вызов
+        if len(candidates) == 1:
+            return {
+                "song": candidates[0],
+                "reasoning": "Единственный найденный кандидат." if return_reasoning else None,
+                "confidence": 1.0
+            }
 
-Выбери ОДНУ песню, наиболее соответствующую запросу, и объясни почему."""
+        # Проверяем кэш: тот же запрос с теми же кандидатами уже решён
+        cache_key = self._cache_key(user_query, candidates, return_reasoning)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            return cached
 
         try:
-            # Формируем полный промпт
-            full_prompt = prompt
-            
+            # Создание промпта с Few-shot Learning
+            # Используем ТОЛЬКО исходный запрос пользователя для более точного понимания его намерения
+            prompt = self._build_choose_prompt(user_query, candidates)
+
             headers = {
                 'Content-Type': 'application/json',
                 'X-goog-api-key': self.api_key
             }
-            
-            # Используем Structured Output (JSON режим) если поддерживается
-            # Для Gemini используем responseSchema
-            payload = {
-                "contents": [{
-                    "parts": [{"text": full_prompt}]
-                }],
-                "generationConfig": {
-                    "temperature": 0.7,
-                    "responseMimeType": "application/json",
-                    "responseSchema": {
-                        "type": "object",
-                        "properties": {
-                            "selected_index": {
-                                "type": "integer",
-                                "description": "Номер выбранной песни (1-based)"
-                            },
-                            "reasoning": {
-                                "type": "string",
-                                "description": "Подробное объяснение, почему эта песня лучше всего подходит запросу пользователя"
-                            },
-                            "confidence": {
-                                "type": "number",
-                                "description": "Уверенность в выборе от 0 до 1"
-                            }
-                        },
-                        "required": ["selected_index", "reasoning"]
-                    }
-                }
-            }
-            
+
+            # Используем Structured Output (JSON режим); статические части тела
+            # предсериализованы, кодируется только промпт
+            body = self._build_choose_body(prompt)
+
             # Пытаемся выполнить запрос с автоматическим переключением моделей
-            api_result = self._try_request_with_fallback(payload, headers)
-            response_text = api_result["candidates"][0]["content"]["parts"][0]["text"]
-            
-            # Пытаемся распарсить JSON ответ
-            try:
-                json_response = json.loads(response_text)
-                selected_index = json_response.get("selected_index")
-                reasoning = json_response.get("reasoning", "")
-                confidence = json_response.get("confidence", 0.5)
-            except (json.JSONDecodeError, KeyError):
-                # Если JSON не распарсился, используем старый метод парсинга
-                reasoning = response_text
-                selected_index = self._parse_selection(reasoning, len(candidates))
-                confidence = 0.5
-            
-            if selected_index is None or not (1 <= selected_index <= len(candidates)):
-                # Если не удалось распарсить, берём первую песню
-                selected_song = candidates[0]
-                if not reasoning:
-                    reasoning = "Не удалось определить выбор автоматически. Возвращена первая найденная песня."
-            else:
-                selected_song = candidates[selected_index - 1]
-            
-            result = {
-                "song": selected_song,
-                "reasoning": reasoning if return_reasoning else None,
-                "confidence": confidence
-            }
-            
+            api_result = self._try_request_with_fallback(body, headers)
+            result = self._parse_choose_response(api_result, candidates, return_reasoning)
+            self._cache_set(cache_key, result)
             return result
-            
+
         except Exception as e:
-            print(f"Ошибка при выборе песни: {e}")
+            logger.warning("Ошибка при выборе песни: %s", e)
             # В случае ошибки возвращаем первую песню
             return {
                 "song": candidates[0],
                 "reasoning": "Произошла ошибка при анализе. Возвращена первая найденная песня."
             }
     
+    def choose_best_multi(
+        self,
+        tasks: List[Any],
+        return_reasoning: bool = True
+    ) -> List[Dict[str, Any]]:
+        """
+        Выбирает лучшие песни сразу для нескольких запросов ОДНИМ LLM вызовом.
+        Вместо K последовательных запросов к API строится один промпт со всеми
+        парами (запрос, кандидаты), а модель возвращает JSON-массив решений.
+
+        Args:
+            tasks: Список пар (user_query, candidates)
+            return_reasoning: Возвращать ли объяснение выбора
+
+        Returns:
+            Список результатов (как у choose_best) в порядке запросов
+        """
+        if not tasks:
+            return []
+        if len(tasks) == 1:
+            user_query, candidates = tasks[0]
+            return [self.choose_best(user_query, candidates, return_reasoning)]
+
+        headers = {
+            'Content-Type': 'application/json',
+            'X-goog-api-key': self.api_key
+        }
+        tasks = self._truncate_tasks(tasks)
+        payload = self._build_multi_payload(tasks)
+
+        try:
+            api_result = self._try_request_with_fallback(payload, headers)
+            response_text = api_result["candidates"][0]["content"]["parts"][0]["text"]
+            decisions = orjson.loads(response_text)
+            if not isinstance(decisions, list):
+                raise ValueError("Ожидался JSON-массив решений")
+        except Exception as e:
+            # Батч-вызов не удался — откатываемся на поштучную обработку
+            logger.warning("Ошибка батч-выбора, переходим на поштучный режим: %s", e)
+            return [
+                self.choose_best(user_query, candidates, return_reasoning)
+                for user_query, candidates in tasks
+            ]
+
+        return self._map_multi_decisions(decisions, tasks, return_reasoning)
+
+    def _truncate_tasks(self, tasks: List[Any]) -> List[Any]:
+        """
+        Обрезает кандидатов каждой задачи до top_k один раз: и промпт,
+        и маппинг решений работают с одним списком, иначе selected_index
+        за пределами показанного модели прошёл бы проверку границ.
+        """
+        if not self.top_k:
+            return tasks
+        return [
+            (user_query, candidates[:self.top_k])
+            for user_query, candidates in tasks
+        ]
+
+    def _build_multi_payload(self, tasks: List[Any]) -> Dict[str, Any]:
+        """
+        Собирает промпт и payload батч-режима для списка пар (запрос, кандидаты).
+        Кандидаты должны быть уже обрезаны до top_k (см. _truncate_tasks).
+
+        Args:
+            tasks: Список пар (user_query, candidates)
+
+        Returns:
+            Словарь payload для API с массивной responseSchema
+        """
+        task_blocks = []
+        for task_idx, (user_query, candidates) in enumerate(tasks, 1):
+            if not candidates:
+                raise ValueError(f"Список кандидатов пуст для запроса {task_idx}!")
+            candidates_text = ""
+            for idx, song in enumerate(candidates, 1):
+                candidates_text += self._format_song_info(song, idx)
+            task_blocks.append(
+                f'Запрос {task_idx}: "{user_query}"\nКандидаты запроса {task_idx}:{candidates_text}'
+            )
+
+        prompt = _CHOOSE_MULTI_PROMPT.format(
+            tasks="\n\n".join(task_blocks),
+            count=len(tasks)
+        )
+
+        return {
+            "contents": [{
+                "parts": [{"text": prompt}]
+            }],
+            "generationConfig": {
+                "temperature": 0.7,
+                "responseMimeType": "application/json",
+                "responseSchema": {
+                    "type": "array",
+                    "items": _CHOOSE_MULTI_ITEM_SCHEMA,
+                    "minItems": len(tasks),
+                    "maxItems": len(tasks)
+                }
+            }
+        }
+
+    def _map_multi_decisions(
+        self,
+        decisions: List[Any],
+        tasks: List[Any],
+        return_reasoning: bool = True
+    ) -> List[Dict[str, Any]]:
+        """
+        Раскладывает решения батч-ответа по запросам
+        (query_index приоритетнее позиции в массиве).
+
+        Args:
+            decisions: Массив решений из ответа модели
+            tasks: Список пар (user_query, candidates)
+            return_reasoning: Возвращать ли объяснение выбора
+
+        Returns:
+            Список результатов (как у choose_best) в порядке запросов
+        """
+        results: List[Any] = [None] * len(tasks)
+        for pos, decision in enumerate(decisions):
+            if not isinstance(decision, dict):
+                continue
+            query_index = decision.get("query_index")
+            task_idx = query_index - 1 if isinstance(query_index, int) and 1 <= query_index <= len(tasks) else pos
+            if task_idx >= len(tasks) or results[task_idx] is not None:
+                continue
+
+            _, candidates = tasks[task_idx]
+            selected_index = decision.get("selected_index")
+            if isinstance(selected_index, int) and 1 <= selected_index <= len(candidates):
+                selected_song = candidates[selected_index - 1]
+            else:
+                selected_song = candidates[0]
+
+            results[task_idx] = {
+                "song": selected_song,
+                "reasoning": decision.get("reasoning", "") if return_reasoning else None,
+                "confidence": decision.get("confidence", 0.5)
+            }
+
+        # Запросы, для которых модель не вернула решения, получают первого кандидата
+        for task_idx, result in enumerate(results):
+            if result is None:
+                _, candidates = tasks[task_idx]
+                results[task_idx] = {
+                    "song": candidates[0],
+                    "reasoning": "Не удалось определить выбор автоматически. Возвращена первая найденная песня." if return_reasoning else None,
+                    "confidence": 0.0
+                }
+
+        return results
+
+    async def choose_best_megabatch(
+        self,
+        queries: List[str],
+        candidates_list: List[List[Dict[str, Any]]],
+        sub_batch_size: int = 8
+    ) -> List[Dict[str, Any]]:
+        """
+        Обрабатывает большой список запросов, группируя их в подбатчи по
+        sub_batch_size: каждый подбатч уходит одним LLM вызовом (как в
+        choose_best_multi), а сами подбатчи выполняются параллельно через
+        общую aiohttp-сессию. Так фиксированные накладные расходы запроса
+        (TLS, авторизация, очередь на бэкенде) амортизируются на несколько
+        запросов сразу.
+
+        Args:
+            queries: Список запросов пользователей
+            candidates_list: Список списков кандидатов для каждого запроса
+            sub_batch_size: Сколько запросов укладывать в один LLM вызов
+
+        Returns:
+            Список результатов для каждого запроса (в исходном порядке)
+        """
+        if len(queries) != len(candidates_list):
+            raise ValueError("Количество запросов должно совпадать с количеством списков кандидатов")
+        if not queries:
+            return []
+
+        tasks = list(zip(queries, candidates_list))
+        session = self._get_session()
+        headers = {
+            'Content-Type': 'application/json',
+            'X-goog-api-key': self.api_key
+        }
+
+        async def run_chunk(chunk):
+            chunk = self._truncate_tasks(chunk)
+            payload = self._build_multi_payload(chunk)
+            try:
+                api_result = await self._try_request_with_fallback_async(payload, headers, session)
+                response_text = api_result["candidates"][0]["content"]["parts"][0]["text"]
+                decisions = orjson.loads(response_text)
+                if not isinstance(decisions, list):
+                    raise ValueError("Ожидался JSON-массив решений")
+                return self._map_multi_decisions(decisions, chunk)
+            except Exception as e:
+                # Подбатч не удался — обрабатываем его запросы поштучно
+                logger.warning("Ошибка подбатча, переходим на поштучный режим: %s", e)
+                return await self.choose_best_batch(
+                    [query for query, _ in chunk],
+                    [candidates for _, candidates in chunk]
+                )
+
+        chunks = [tasks[i:i + sub_batch_size] for i in range(0, len(tasks), sub_batch_size)]
+        chunk_results = await asyncio.gather(*(run_chunk(chunk) for chunk in chunks))
+
+        results = []
+        for part in chunk_results:
+            results.extend(part)
+        return results
+
     def _parse_selection(self, reasoning: str, max_index: int) -> int:
         """
         Парсит ответ LLM для извлечения номера выбранной песни.
@@ -573,150 +1603,193 @@ class SongSelector:
         Returns:
             Номер выбранной песни (1-based) или None
         """
-        import re
-        
         # Ищем паттерны типа "ВЫБОР: 1" или "1." или просто число в начале
-        patterns = [
-            r'ВЫБОР:\s*(\d+)',
-            r'выбор:\s*(\d+)',
-            r'Выбор:\s*(\d+)',
-            r'^(\d+)\.',
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, reasoning, re.IGNORECASE | re.MULTILINE)
+        for pattern in self._CHOICE_PATTERNS:
+            match = pattern.search(reasoning)
             if match:
                 num = int(match.group(1))
                 if 1 <= num <= max_index:
                     return num
-        
+
         # Если не нашли явного указания, ищем числа в тексте
-        numbers = re.findall(r'\b(\d+)\b', reasoning)
-        for num_str in numbers:
-            num = int(num_str)
+        for match in self._NUM_PATTERN.finditer(reasoning):
+            num = int(match.group(1))
             if 1 <= num <= max_index:
                 return num
-        
+
         return None
     
+    async def _choose_stream_async(
+        self,
+        payload: Dict[str, Any],
+        headers: Dict[str, str],
+        session: aiohttp.ClientSession,
+        candidates: List[Dict[str, Any]]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Потоковый вариант выбора через :streamGenerateContent (SSE).
+        Когда объяснение не нужно, достаточно поля selected_index — выходим
+        из потока, как только оно появилось в накопленном тексте, не дожидаясь
+        генерации reasoning целиком.
+
+        Args:
+            payload: Тело запроса (как для generateContent)
+            headers: Заголовки запроса
+            session: aiohttp сессия
+            candidates: Список кандидатов
+
+        Returns:
+            Результат выбора или None, если поток не дал ответа
+            (тогда вызывающий код откатывается на обычный запрос)
+        """
+        model_name = self.last_successful_model or self.model
+        if model_name in self._dead_models:
+            return None
+        url = f"{_API_BASE}/{model_name}:streamGenerateContent?alt=sse"
+        body = payload if isinstance(payload, bytes) else _JSON_ENCODER.encode(payload)
+        text_so_far = ""
+
+        try:
+            await self._bucket.acquire()
+            async with session.post(url, headers=headers, data=body) as response:
+                if response.status != 200:
+                    if response.status == 429:
+                        self._bucket.penalize()
+                    return None
+                async for raw_line in response.content:
+                    line = raw_line.strip()
+                    if not line.startswith(b"data:"):
+                        continue
+                    chunk = line[5:].strip()
+                    if not chunk or chunk == b"[DONE]":
+                        continue
+                    try:
+                        event = orjson.loads(chunk)
+                        parts = event["candidates"][0]["content"]["parts"]
+                        text_so_far += "".join(p.get("text", "") for p in parts)
+                    except (ValueError, KeyError, IndexError):
+                        continue
+
+                    # Ждём терминатор после числа: совпадение префикса
+                    # недописанного многозначного индекса дало бы не ту песню
+                    index_match = _SELECTED_INDEX_DONE_RE.search(text_so_far)
+                    if not index_match:
+                        continue
+                    selected_index = int(index_match.group(1))
+                    if not (1 <= selected_index <= len(candidates)):
+                        return None
+                    conf_match = _CONFIDENCE_DONE_RE.search(text_so_far)
+                    # Индекс получен — остаток потока (reasoning) нам не нужен
+                    response.close()
+                    self.last_successful_model = model_name
+                    return {
+                        "song": candidates[selected_index - 1],
+                        "reasoning": None,
+                        "confidence": float(conf_match.group(1)) if conf_match else 0.5
+                    }
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return None
+
+        return None
+
     async def choose_best_async(
         self,
         user_query: str,
         candidates: List[Dict[str, Any]],
-        session: aiohttp.ClientSession,
+        session: aiohttp.ClientSession = None,
         return_reasoning: bool = True
     ) -> Dict[str, Any]:
         """
         Асинхронная версия choose_best.
-        
+
         Args:
             user_query: Запрос пользователя
             candidates: Список кандидатов (песен)
-            session: aiohttp сессия
+            session: aiohttp сессия (по умолчанию общая сессия селектора)
             return_reasoning: Возвращать ли объяснение выбора
-            
+
         Returns:
             Словарь с выбранной песней и объяснением
         """
+        if session is None:
+            session = self._get_session()
         if not candidates:
             raise ValueError("Список кандидатов пуст!")
-        
-        # Форматирование списка кандидатов
-        candidates_text = ""
-        for idx, song in enumerate(candidates, 1):
-            candidates_text += self._format_song_info(song, idx)
-        
-        # Создание промпта (тот же, что и в синхронной версии)
-        prompt = f"""Ты христианский эксперт, выбери лучшую христианскую песню из кандидатов для запроса пользователя.
 
-Пример:
-Запрос: "Хочу спокойную песню для вечера"
-1. Тихая ночь (спокойная, умиротворённая)
-2. Утренняя радость (энергичная, радостная)
-ВЫБОР: 1
-ОБЪЯСНЕНИЕ: "Тихая ночь" подходит для вечера - спокойная и умиротворённая.
+        # Поиск уже отранжировал кандидатов — в промпт отдаём только верхние
+        # top_k, чтобы не раздувать вход модели длинным хвостом
+        if self.top_k and len(candidates) > self.top_k:
+            candidates = candidates[:self.top_k]
 
-Запрос: "{user_query}"
-Кандидаты:
-{candidates_text}
+        # Если кандидат один, выбирать не из чего — не тратим LLM вызов
+        if len(candidates) == 1:
+            return {
+                "song": candidates[0],
+                "reasoning": "Единственный найденный кандидат." if return_reasoning else None,
+                "confidence": 1.0
+            }
 
-Выбери ОДНУ песню, наиболее соответствующую запросу, и объясни почему."""
-        
+        # Проверяем кэш: тот же запрос с теми же кандидатами уже решён
+        cache_key = self._cache_key(user_query, candidates, return_reasoning)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            return cached
+
+        # Single-flight: если такой же запрос уже в полёте, ждём его результат
+        inflight = self._inflight.get(cache_key)
+        if inflight is not None:
+            try:
+                return await inflight
+            except Exception:
+                # Владельца отменили, не дождавшись результата — выполняем
+                # запрос самостоятельно, как если бы полёта не было
+                pass
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[cache_key] = future
         try:
-            headers = {
-                'Content-Type': 'application/json',
-                'X-goog-api-key': self.api_key
-            }
-            
-            payload = {
-                "contents": [{
-                    "parts": [{"text": prompt}]
-                }],
-                "generationConfig": {
-                    "temperature": 0.7,
-                    "responseMimeType": "application/json",
-                    "responseSchema": {
-                        "type": "object",
-                        "properties": {
-                            "selected_index": {
-                                "type": "integer",
-                                "description": "Номер выбранной песни (1-based)"
-                            },
-                            "reasoning": {
-                                "type": "string",
-                                "description": "Подробное объяснение выбора"
-                            },
-                            "confidence": {
-                                "type": "number",
-                                "description": "Уверенность в выборе от 0 до 1"
-                            }
-                        },
-                        "required": ["selected_index", "reasoning"]
-                    }
+            try:
+                # Создание промпта (тот же шаблон и payload, что и в синхронной версии)
+                prompt = self._build_choose_prompt(user_query, candidates)
+
+                headers = {
+                    'Content-Type': 'application/json',
+                    'X-goog-api-key': self.api_key
                 }
-            }
-            
-            # Асинхронный запрос
-            api_url = f"https://generativelanguage.googleapis.com/v1beta/models/{self.model}:generateContent"
-            async with session.post(api_url, headers=headers, json=payload) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    raise Exception(f"API error {response.status}: {error_text}")
-                
-                api_result = await response.json()
-                response_text = api_result["candidates"][0]["content"]["parts"][0]["text"]
-                
-                # Парсинг JSON
-                try:
-                    json_response = json.loads(response_text)
-                    selected_index = json_response.get("selected_index")
-                    reasoning = json_response.get("reasoning", "")
-                    confidence = json_response.get("confidence", 0.5)
-                except (json.JSONDecodeError, KeyError):
-                    reasoning = response_text
-                    selected_index = self._parse_selection(reasoning, len(candidates))
-                    confidence = 0.5
-                
-                if selected_index is None or not (1 <= selected_index <= len(candidates)):
-                    selected_song = candidates[0]
-                    if not reasoning:
-                        reasoning = "Не удалось определить выбор автоматически."
-                else:
-                    selected_song = candidates[selected_index - 1]
-                
-                return {
-                    "song": selected_song,
-                    "reasoning": reasoning if return_reasoning else None,
-                    "confidence": confidence
+
+                body = self._build_choose_body(prompt)
+
+                # Без reasoning пробуем потоковый путь: выходим из SSE-потока,
+                # как только пришёл selected_index
+                result = None
+                if not return_reasoning:
+                    result = await self._choose_stream_async(body, headers, session, candidates)
+
+                if result is None:
+                    # Асинхронный запрос с тем же fallback-механизмом, что и в sync версии
+                    api_result = await self._try_request_with_fallback_async(body, headers, session)
+                    result = self._parse_choose_response(api_result, candidates, return_reasoning)
+                self._cache_set(cache_key, result)
+
+            except Exception as e:
+                logger.warning("Ошибка при выборе песни: %s", e)
+                result = {
+                    "song": candidates[0],
+                    "reasoning": "Произошла ошибка при анализе. Возвращена первая найденная песня.",
+                    "confidence": 0.0
                 }
-                
-        except Exception as e:
-            print(f"Ошибка при выборе песни: {e}")
-            return {
-                "song": candidates[0],
-                "reasoning": "Произошла ошибка при анализе. Возвращена первая найденная песня.",
-                "confidence": 0.0
-            }
+
+            future.set_result(result)
+            return result
+        finally:
+            # CancelledError не ловится внутренним except Exception: если
+            # владельца отменили, будим ожидающих. Не через cancel() — отмена
+            # каскадом оборвала бы не связанные с владельцем корутины, —
+            # а ошибкой, по которой каждый ожидающий выполнит запрос сам
+            if not future.done():
+                future.set_exception(Exception("single-flight: владелец отменён"))
+                future.exception()  # прочитано: без ожидающих warning не нужен
+            self._inflight.pop(cache_key, None)
     
     async def choose_best_batch(
         self,
@@ -733,27 +1806,54 @@ class SongSelector:
         Returns:
             Список результатов для каждого запроса
         """
+        results: List[Any] = [None] * len(queries)
+        async for index, result in self.choose_best_batch_iter(queries, candidates_list):
+            results[index] = result
+        return results
+
+    async def choose_best_batch_iter(
+        self,
+        queries: List[str],
+        candidates_list: List[List[Dict[str, Any]]],
+        max_concurrency: int = 50
+    ) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+        """
+        Потоковая версия choose_best_batch: отдаёт пары (индекс запроса,
+        результат) по мере готовности, не дожидаясь самого медленного вызова.
+        Первый результат доступен через ~латентность одного вызова, что
+        позволяет потребителю обрабатывать ответы конвейерно.
+
+        Args:
+            queries: Список запросов пользователей
+            candidates_list: Список списков кандидатов для каждого запроса
+            max_concurrency: Максимум одновременных вызовов (семафор)
+
+        Yields:
+            Кортежи (индекс запроса, результат как у choose_best)
+        """
         if len(queries) != len(candidates_list):
             raise ValueError("Количество запросов должно совпадать с количеством списков кандидатов")
-        
-        async with aiohttp.ClientSession() as session:
-            tasks = [
-                self.choose_best_async(query, candidates, session)
-                for query, candidates in zip(queries, candidates_list)
-            ]
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            
-            # Обрабатываем исключения
-            processed_results = []
-            for result in results:
-                if isinstance(result, Exception):
-                    processed_results.append({
+
+        # Переиспользуем общую сессию вместо создания новой на каждый батч
+        session = self._get_session()
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def run_one(index: int, query: str, candidates: List[Dict[str, Any]]):
+            async with semaphore:
+                try:
+                    result = await self.choose_best_async(query, candidates, session)
+                except Exception as e:
+                    result = {
                         "song": None,
-                        "reasoning": f"Ошибка: {str(result)}",
+                        "reasoning": f"Ошибка: {str(e)}",
                         "confidence": 0.0
-                    })
-                else:
-                    processed_results.append(result)
-            
-            return processed_results
+                    }
+                return index, result
+
+        tasks = [
+            asyncio.ensure_future(run_one(index, query, candidates))
+            for index, (query, candidates) in enumerate(zip(queries, candidates_list))
+        ]
+        for completed in asyncio.as_completed(tasks):
+            yield await completed
 
@@ -5,8 +5,7 @@
 
 import os
 import sys
-import json
-import numpy as np
+import orjson
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -14,16 +13,16 @@ from dotenv import load_dotenv
 source_dir = Path(__file__).parent
 sys.path.insert(0, str(source_dir))
 
-# Импорт EmbeddingsManager
-from embeddings_manager import EmbeddingsManager
-
 # Загрузка переменных окружения
 load_dotenv()
 
 
 def test_with_existing_logic():
     """Тест с использованием существующей логики проекта."""
-    
+    # Импорт здесь, чтобы сам модуль импортировался без numpy/faiss
+    from embeddings_manager import EmbeddingsManager
+
+
     print("=" * 60)
     print("🎵 Тест системы поиска песен с существующей логикой")
     print("=" * 60)
@@ -45,10 +44,9 @@ def test_with_existing_logic():
     
     print(f"\n📖 Загрузка песен из {songs_path}...")
     
-    # Загрузка песен
+    # Загрузка песен (orjson парсит байты напрямую, UTF-8 — нативно)
     try:
-        with open(songs_path, 'r', encoding='utf-8') as f:
-            songs_data = json.load(f)
+        songs_data = orjson.loads(songs_path.read_bytes())
         
         # Обработка разных форматов JSON
         if isinstance(songs_data, dict):
@@ -124,15 +122,18 @@ def test_with_existing_logic():
         
         # Поиск в индексе
         distances, indices = embeddings_manager.index.search(query_embedding, k)
-        
+
+        # Векторный постпроцессинг: маска валидных индексов и приведение
+        # типов выполняются в numpy одним махом, без поэлементных проверок
+        idx_row = indices[0]
+        valid = (idx_row >= 0) & (idx_row < len(embeddings_manager.vectors_metadata))
+
         # Получение метаданных найденных песен
         results = []
-        for idx, distance in zip(indices[0], distances[0]):
-            if idx < len(embeddings_manager.vectors_metadata):
-                song_data = embeddings_manager.vectors_metadata[idx]["metadata"].copy()
-                song_data["similarity_distance"] = float(distance)
-                results.append(song_data)
-        
+        for idx, distance in zip(idx_row[valid].tolist(), distances[0][valid].tolist()):
+            meta = embeddings_manager.vectors_metadata[idx]["metadata"]
+            results.append({**meta, "similarity_distance": distance})
+
         return results
     
     print("\n🔍 Поисковая система готова")
@@ -3,54 +3,95 @@
 Flask веб-сервер с современным интерфейсом.
 """
 
+import collections
+import logging
 import os
 import sys
-import json
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import orjson
 from flask import Flask, render_template, request, jsonify
+from flask.json.provider import JSONProvider
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from dotenv import load_dotenv
-from pydantic import BaseModel, ValidationError, field_validator
+from pydantic import BaseModel, ConfigDict, ValidationError, field_validator
+from typing import Literal
 
 # Добавляем путь к Source для импорта модулей
 sys.path.insert(0, str(Path(__file__).parent))
 
-from embeddings_manager import EmbeddingsManager
-from song_search import SongSearch
-from song_selector import SongSelector
+# Тяжёлые компоненты (numpy, faiss, aiohttp) импортируются внутри init_system:
+# импорт модуля (gunicorn preload, SKIP_INIT, инструменты) остаётся лёгким
 
 # Загрузка переменных окружения
 load_dotenv()
 
+# Компоненты (song_selector и др.) пишут события retry/fallback/квот через
+# logging с NullHandler — без конфигурации на уровне приложения эти сигналы
+# молча пропадают. Уровень управляется через LOG_LEVEL
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+
+class OrjsonProvider(JSONProvider):
+    """
+    JSON-провайдер Flask на orjson: C-сериализация с SIMD-экранированием
+    строк заметно быстрее stdlib json на ответах с кириллическими текстами
+    песен, а NumPy-типы (match_percent и т.п.) сериализуются нативно.
+    """
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+# Статика отдаётся с Cache-Control: max-age=86400 — повторные визиты
+# не перечитывают css/js/иконки с диска
+app.send_file_max_age_default = 86400
 
-# Настройка Rate Limiting
+# Настройка Rate Limiting.
+# fixed-window хранит один счётчик на (ключ, окно) вместо списка таймстампов,
+# поэтому проверка лимита — O(1) даже под флудом. Через REDIS_URL счётчики
+# можно вынести в Redis и разделить между несколькими инстансами
 limiter = Limiter(
     app=app,
     key_func=get_remote_address,
     default_limits=["100 per hour"],
-    storage_uri="memory://"
+    strategy="fixed-window",
+    storage_uri=os.getenv("REDIS_URL", "memory://")
 )
 
-# Валидация входных данных
+# Валидация входных данных.
+# Обрезка пробелов, лимит длины строк и отбрасывание лишних полей выполняются
+# Rust-ядром pydantic (model_config), а не Python-валидаторами на каждый запрос
 class SearchRequest(BaseModel):
+    model_config = ConfigDict(
+        str_strip_whitespace=True,
+        str_max_length=500,
+        extra='ignore',
+        frozen=True
+    )
+
     query: str
     use_hybrid: bool = True
     semantic_weight: float = 0.55
     keyword_weight: float = 0.45
     enhance_query: bool = True  # Предобработка запроса через AI для улучшения векторного поиска
-    
+
     @field_validator('query')
     @classmethod
     def validate_query(cls, v):
-        if not v or not v.strip():
+        if not v:
             raise ValueError('Запрос не может быть пустым')
-        if len(v) > 500:
-            raise ValueError('Запрос слишком длинный (максимум 500 символов)')
-        return v.strip()
-    
+        return v
+
     @field_validator('semantic_weight', 'keyword_weight')
     @classmethod
     def validate_weights(cls, v):
@@ -59,30 +100,44 @@ class SearchRequest(BaseModel):
         return v
 
 class FeedbackRequest(BaseModel):
+    model_config = ConfigDict(
+        str_strip_whitespace=True,
+        str_max_length=500,
+        extra='ignore',
+        frozen=True
+    )
+
     query: str
     selected_song_id: str
-    feedback: str  # 'like' или 'dislike'
-    
-    @field_validator('feedback')
-    @classmethod
-    def validate_feedback(cls, v):
-        if v not in ['like', 'dislike']:
-            raise ValueError('Feedback должен быть "like" или "dislike"')
-        return v
+    feedback: Literal['like', 'dislike']
 
 # Глобальные переменные для компонентов системы
 embeddings_manager = None
 search_engine = None
 selector = None
 
-# Хранилище feedback (в продакшене использовать БД)
-feedback_storage = []
+# Хранилище feedback (в продакшене использовать БД):
+# deque с maxlen вытесняет старые записи за O(1) вместо list.pop(0)
+feedback_storage = collections.deque(maxlen=1000)
+
+# Инкрементальные счётчики лайков/дизлайков: статистика отдаётся за O(1)
+# без повторного сканирования хранилища на каждый запрос
+feedback_counts = {'like': 0, 'dislike': 0}
+
+# Пул для перекрытия улучшения запроса и векторного поиска:
+# оба упираются в I/O (Google API), поэтому выполняются параллельно
+executor = ThreadPoolExecutor(max_workers=4)
 
 
 def init_system():
     """Инициализирует систему поиска песен."""
     global embeddings_manager, search_engine, selector
-    
+
+    # Отложенный импорт тяжёлых компонентов (см. комментарий у заголовка файла)
+    from embeddings_manager import EmbeddingsManager
+    from song_search import SongSearch
+    from song_selector import SongSelector
+
     # Пути к файлам
     project_root = Path(__file__).parent.parent
     index_path = project_root / "Data" / "songs_index.faiss"
@@ -101,6 +156,10 @@ def init_system():
             "GOOGLE_API_KEY не установлен! Создайте файл .env и добавьте: GOOGLE_API_KEY=your_key_here"
         )
     
+    # FAISS по умолчанию консервативен с потоками — отдаём ему все ядра
+    import faiss
+    faiss.omp_set_num_threads(os.cpu_count() or 1)
+
     # Инициализация компонентов
     embeddings_manager = EmbeddingsManager(api_key=google_api_key)
     embeddings_manager.load_index(str(index_path), str(metadata_path))
@@ -121,7 +180,11 @@ def index():
 def favicon():
     """Обработчик для favicon."""
     from flask import send_from_directory
-    return send_from_directory(app.static_folder, 'favicon.svg', mimetype='image/svg+xml')
+    resp = send_from_directory(app.static_folder, 'favicon.svg', mimetype='image/svg+xml')
+    # Браузер кэширует иконку на сутки вместо запроса при каждом визите
+    resp.cache_control.public = True
+    resp.cache_control.max_age = 86400
+    return resp
 
 
 @app.route('/api/search', methods=['POST'])
@@ -139,13 +202,34 @@ def search_songs():
         if search_engine is None or selector is None:
             return jsonify({'error': 'Система не инициализирована'}), 500
         
+        # Поиск кандидатов (hybrid или обычный)
+        # k=12 — больше кандидатов, чтобы тематические песни (напр. про осень) попадали в выбор
+        k_candidates = 12
+
+        def run_search(q):
+            if search_request.use_hybrid and hasattr(search_engine, 'hybrid_search'):
+                return search_engine.hybrid_search(
+                    q,
+                    k=k_candidates,
+                    semantic_weight=search_request.semantic_weight,
+                    keyword_weight=search_request.keyword_weight
+                )
+            return search_engine.search(q, k=k_candidates)
+
         # Предобработка запроса через AI для улучшения векторного поиска
-        # Для векторного поиска используем: исходный запрос + уточнение от ИИ
+        # Для векторного поиска используем: исходный запрос + уточнение от ИИ.
+        # Улучшение и поиск по исходному запросу выполняются параллельно:
+        # оба ждут внешнего API, и поиск по исходному запросу пригодится,
+        # если улучшение ничего не изменило или упало
         search_query = search_request.query
         enhanced_data = None
-        
+        enhance_cache_hit = False
+        search_future = None
+
         if search_request.enhance_query:
             try:
+                enhance_cache_hit = selector.is_enhance_cached(search_request.query)
+                search_future = executor.submit(run_search, search_request.query)
                 enhanced_data = selector.enhance_query(search_request.query)
                 if enhanced_data and isinstance(enhanced_data, dict):
                     enhanced_query = enhanced_data.get("enhanced_query", "").strip()
@@ -171,19 +255,13 @@ def search_songs():
             except Exception as e:
                 print(f"⚠️ Ошибка при улучшении запроса, используем исходный: {e}")
                 search_query = search_request.query
-        
-        # Поиск кандидатов (hybrid или обычный) с улучшенным запросом
-        # k=12 — больше кандидатов, чтобы тематические песни (напр. про осень) попадали в выбор
-        k_candidates = 12
-        if search_request.use_hybrid and hasattr(search_engine, 'hybrid_search'):
-            candidates = search_engine.hybrid_search(
-                search_query, 
-                k=k_candidates,
-                semantic_weight=search_request.semantic_weight,
-                keyword_weight=search_request.keyword_weight
-            )
+
+        # Если улучшение изменило запрос — ищем заново по комбинированному,
+        # иначе забираем уже готовый результат параллельного поиска
+        if search_future is not None and search_query == search_request.query:
+            candidates = search_future.result()
         else:
-            candidates = search_engine.search(search_query, k=k_candidates)
+            candidates = run_search(search_query)
         
         # Отладка: выводим структуру данных кандидатов
         print(f"\n🔍 Найдено {len(candidates)} кандидатов:")
@@ -251,8 +329,11 @@ def search_songs():
             'message': 'Поиск выполнен успешно',
             'enhanced_query': enhanced_query_value
         }
-        
-        return jsonify(response)
+
+        resp = jsonify(response)
+        # Повторные популярные запросы не платят за улучшение запроса API-вызовом
+        resp.headers['X-Cache'] = 'hit' if enhance_cache_hit else 'miss'
+        return resp
         
     except Exception as e:
         print(f"Ошибка при поиске: {e}")
@@ -301,12 +382,13 @@ def submit_feedback():
             'feedback': feedback_request.feedback,
             'timestamp': time.time()
         }
+        # Перед вытеснением старой записи из заполненного deque
+        # убираем её вклад из счётчиков
+        if len(feedback_storage) == feedback_storage.maxlen:
+            feedback_counts[feedback_storage[0]['feedback']] -= 1
         feedback_storage.append(feedback_entry)
-        
-        # Ограничиваем размер хранилища
-        if len(feedback_storage) > 1000:
-            feedback_storage.pop(0)
-        
+        feedback_counts[feedback_request.feedback] += 1
+
         return jsonify({
             'status': 'success',
             'message': 'Feedback сохранён'
@@ -321,13 +403,10 @@ def submit_feedback():
 def get_feedback_stats():
     """Получить статистику feedback."""
     try:
-        likes = sum(1 for f in feedback_storage if f['feedback'] == 'like')
-        dislikes = sum(1 for f in feedback_storage if f['feedback'] == 'dislike')
-        
         return jsonify({
             'total': len(feedback_storage),
-            'likes': likes,
-            'dislikes': dislikes
+            'likes': feedback_counts['like'],
+            'dislikes': feedback_counts['dislike']
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500